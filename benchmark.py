@@ -0,0 +1,119 @@
+import os
+import csv
+import sys
+import time
+import socket
+import argparse
+import resource
+import tempfile
+import subprocess
+
+# Client settings overrides for every benchmarked configuration
+CONFIGS = {
+    "lock-step": {"MAX_FRAMES_IN_FLIGHT": 1},
+    "streaming": {"MAX_FRAMES_IN_FLIGHT": 2},
+    "streaming-3": {"MAX_FRAMES_IN_FLIGHT": 3},
+    "no-roi": {"MAX_FRAMES_IN_FLIGHT": 2, "ROI_CROP": False},
+    "full-quality": {"MAX_FRAMES_IN_FLIGHT": 2, "ROI_CROP": False, "ENCODER_LEVELS": [(1., 90)]},
+}
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+def cpu_seconds(pid: int) -> float:
+    """User + system CPU time of a running process (Linux only)"""
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def wait_for_server(host: str, port: int, timeout: float = 120.):
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        try:
+            socket.create_connection((host, port), timeout=1.).close()
+            return
+        except OSError:
+            time.sleep(1.)
+    raise TimeoutError(f"Server on {host} port {port} did not come up")
+
+
+def read_timing(path: str):
+    """Last row of every span in a timing CSV"""
+    rows = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            for row in csv.DictReader(f):
+                rows[row["span"]] = row
+    return rows
+
+
+def run_config(name: str, overrides: dict, args, server_pid: int):
+    """Replay the log through one client configuration, returns the result row"""
+    timing_dir = tempfile.mkdtemp(prefix=f"bench_{name}_")
+    overrides = dict(overrides, TIMING=True, TIMING_DIR=timing_dir, TIMING_PERIOD=2 * args.duration)
+    command = [sys.executable, "client.py", args.host, str(args.port), "--replay", args.log,
+               "--loop", "--speed", str(args.speed), "--duration", str(args.duration)]
+    for key, value in overrides.items():
+        command += ["--set", f"{key}={value!r}"]
+    usage_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    server_cpu_before = cpu_seconds(server_pid) if server_pid else 0.
+    subprocess.run(command, cwd=ROOT, stdout=subprocess.DEVNULL, timeout=args.duration + 60)
+    usage_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    server_cpu = cpu_seconds(server_pid) - server_cpu_before if server_pid else float("nan")
+    client_cpu = usage_after.ru_utime + usage_after.ru_stime - usage_before.ru_utime - usage_before.ru_stime
+
+    spans = read_timing(os.path.join(timing_dir, "timing_client.csv"))
+    reply = spans.get("capture_to_reply", {})
+    motor = spans.get("capture_to_motor", {})
+    return {
+        "config": name,
+        "fps": int(reply.get("count", 0)) / args.duration,
+        "reply_p50_ms": float(reply.get("p50_ms", "nan")),
+        "reply_p95_ms": float(reply.get("p95_ms", "nan")),
+        "motor_p50_ms": float(motor.get("p50_ms", "nan")),
+        "motor_p95_ms": float(motor.get("p95_ms", "nan")),
+        "client_cpu_%": 100. * client_cpu / args.duration,
+        "server_cpu_%": 100. * server_cpu / args.duration,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Hardware-free benchmark replaying a recorded log")
+    parser.add_argument("log", help="log recorded with client.py --record")
+    parser.add_argument("--host", default="::1")
+    parser.add_argument("--port", type=int, default=5005)
+    parser.add_argument("--duration", type=float, default=30., help="seconds per configuration")
+    parser.add_argument("--speed", type=float, default=1., help="replay speed factor")
+    parser.add_argument("--config", action="append", choices=sorted(CONFIGS),
+                        help="configurations to run (default: all)")
+    parser.add_argument("--no-server", action="store_true", help="use an already running server")
+    parser.add_argument("--csv", metavar="FILE", help="also write the results to FILE")
+    args = parser.parse_args()
+
+    server = None
+    if not args.no_server:
+        server = subprocess.Popen([sys.executable, "server.py", args.host, str(args.port), "--headless"],
+                                  cwd=ROOT, stdout=subprocess.DEVNULL)
+    try:
+        wait_for_server(args.host, args.port)
+        results = [run_config(name, CONFIGS[name], args, server.pid if server else None)
+                   for name in (args.config or CONFIGS)]
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    columns = list(results[0])
+    print("  ".join(f"{c:>14}" for c in columns))
+    for row in results:
+        print("  ".join(f"{row[c]:>14}" if isinstance(row[c], str) else f"{row[c]:>14.1f}" for c in columns))
+    if args.csv:
+        with open(args.csv, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=columns)
+            writer.writeheader()
+            writer.writerows(results)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,108 +1,399 @@
 import socket
+import struct
 import time
 import cv2
-import sys
-import os
-import struct
+import ast
+import argparse
 import threading
+import _thread
 import numpy as np
 
 import settings
 import motor_control as mc
+import launch_table
+import protocol
+import timing
+import recorder
+import shm_transport
+
+try:
+    import fcntl
+    import termios
+except ImportError:
+    # Not available on Windows, the link throughput is then not measured
+    fcntl = None
 
 # Initialize global variables for scripts that are intended to run
 settings.init()
 
-# Start the range sensor thread
-range_thread = threading.Thread(target=mc.range_sensor_thread)
-esp32_thread = threading.Thread(target=mc.esp32_thread)
-# Set the threads as daemons so they exit when the main thread exits
-range_thread.daemon = True
-esp32_thread.daemon = True
-range_thread.start()
-esp32_thread.start()
+# Load the range-to-launch-command table before the range thread needs it
+try:
+    settings.LAUNCH_TABLE = launch_table.load_table(settings.LAUNCH_TABLE_FILE)
+    print(f"Loaded launch table {settings.LAUNCH_TABLE.key}")
+except (OSError, ValueError) as e:
+    print(f"Could not load launch table ({e}), using fixed firing command")
+
+
+class Camera():
+    """Reads the camera on its own thread, so the newest frame is always at hand"""
+    def __init__(self, cap):
+        self.cap = cap
+        self.cond = threading.Condition()
+        self.frame = None
+        self.capture_ns = 0
+        # Number of frames captured so far
+        self.count = 0
+        self.ok = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while self.ok and not settings.SHOULD_EXIT.is_set():
+            read_ns = timing.now()
+            ret, frame = self.cap.read()
+            capture_ns = time.perf_counter_ns()
+            timing.span("capture", read_ns, capture_ns)
+            with self.cond:
+                if ret:
+                    self.frame, self.capture_ns = frame, capture_ns
+                    self.count += 1
+                else:
+                    self.ok = False
+                self.cond.notify_all()
+
+    def newest(self, last_count: int):
+        """Wait for a frame newer than last_count, returns None if the camera failed"""
+        with self.cond:
+            self.cond.wait_for(lambda: self.count != last_count or not self.ok)
+            if not self.ok:
+                return None
+            return self.count, self.frame, self.capture_ns
+
+
+class Stream():
+    """Frames sent and replies received on one connection"""
+    def __init__(self):
+        self.cond = threading.Condition()
+        # Sequence numbers of the newest frame sent and the newest frame answered
+        self.sent = 0
+        self.answered = 0
+        self.closed = False
+
+
+def unsent_bytes(sock):
+    """Bytes in the socket send queue not yet acknowledged by the server, None where the OS doesn't tell"""
+    if fcntl is None:
+        return None
+    try:
+        return struct.unpack("i", fcntl.ioctl(sock.fileno(), termios.TIOCOUTQ, struct.pack("i", 0)))[0]
+    except OSError:
+        return None
+
+
+class LinkMeter():
+    """
+    Throughput of the link to the server from the kernel send queue. When
+    data is still queued as the next frame is sent, the link never went idle
+    in between, so the bytes it delivered over that time are its capacity.
+    Idle time between frames and inference time on the server don't count.
+    """
+    def __init__(self, sock):
+        self.sock = sock
+        # Bytes handed to the socket so far
+        self.sent = 0
+        # Time and bytes delivered after the previous frame
+        self.mark = None
+        self.queued = None
+
+    def before_send(self):
+        self.queued = unsent_bytes(self.sock)
+
+    def after_send(self, size: int):
+        """Throughput [bytes/s] since the previous frame if the link was busy all along, else None"""
+        now = time.perf_counter()
+        unsent = unsent_bytes(self.sock)
+        self.sent += size
+        if unsent is None:
+            return None
+        mark, self.mark = self.mark, (now, self.sent - unsent)
+        if mark is None or not self.queued or now <= mark[0]:
+            return None
+        return (self.mark[1] - mark[1]) / (now - mark[0])
+
+
+class AdaptiveEncoder():
+    """
+    Encodes frames for sending. Steps through settings.ENCODER_LEVELS of
+    (scale, JPEG quality) from the measured round trip time and link
+    throughput (see LinkMeter), and optionally crops to the region around
+    the last reported person with a periodic full frame to re-acquire.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Index into settings.ENCODER_LEVELS, 0 is the best quality
+        self.level = 0
+        self.level_timer = time.perf_counter()
+        # Smoothed round trip time [s] and link throughput [bytes/s]
+        self.rtt = None
+        self.bandwidth = None
+        # When the link was last found busy from one frame to the next
+        self.busy_timer = None
+        # Sizes of the frames in flight by sequence number
+        self.sizes = {}
+        self.frames_since_full = 0
+
+    def encode(self, frame, seq: int):
+        """Returns the JPEG buffer and its transform (offset x, offset y, scale) in the full frame"""
+        scale, quality = settings.ENCODER_LEVELS[self.level]
+        offset_x = 0
+        left, right = settings.STATE.person_bounds
+        if settings.ROI_CROP and left != settings.INVALID_VALUE \
+           and self.frames_since_full < settings.FULL_FRAME_PERIOD:
+            # Only the horizontal extent matters, keep the full height. The
+            # reported box can reach past the frame, clamp to it
+            margin = settings.ROI_MARGIN * (right - left)
+            crop_left = min(max(int(left - margin), 0), frame.shape[1])
+            crop_right = min(max(int(right + margin), 0), frame.shape[1])
+            if crop_right - crop_left >= settings.ROI_MIN_WIDTH:
+                offset_x = crop_left
+                frame = frame[:, crop_left:crop_right]
+                self.frames_since_full += 1
+            else:
+                self.frames_since_full = 0
+        else:
+            self.frames_since_full = 0
+        if scale != 1.:
+            frame = cv2.resize(frame, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        _, buffer = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, quality])
+        with self.lock:
+            self.sizes[seq] = len(buffer)
+        return buffer, (offset_x, 0, scale)
+
+    def on_send(self, throughput):
+        """Update the link throughput with a LinkMeter sample, None when the link was not busy"""
+        if throughput is None:
+            return
+        a = settings.ENCODER_SMOOTHING
+        self.bandwidth = throughput if self.bandwidth is None else (1 - a) * self.bandwidth + a * throughput
+        self.busy_timer = time.perf_counter()
+
+    def on_reply(self, seq: int, rtt: float):
+        """Update the round trip time with a reply and adapt the encoding level"""
+        now = time.perf_counter()
+        with self.lock:
+            size = self.sizes.pop(seq, 0)
+            # Frames older than the reply were dropped by the server
+            for old in [s for s in self.sizes if s < seq]:
+                del self.sizes[old]
+        a = settings.ENCODER_SMOOTHING
+        self.rtt = rtt if self.rtt is None else (1 - a) * self.rtt + a * rtt
+        if now < self.level_timer + settings.ENCODER_HOLD:
+            return
+        # The link only limits the level when it has been busy lately, an idle link keeps up
+        busy = self.busy_timer is not None and now < self.busy_timer + settings.ENCODER_HOLD
+        # Throughput the current level needs at the camera frame rate
+        needed = size * settings.CAM_FPS
+        if (self.rtt > settings.TARGET_RTT or busy and needed > self.bandwidth) \
+           and self.level < len(settings.ENCODER_LEVELS) - 1:
+            self.level += 1
+            self.level_timer = now
+        elif self.rtt < .5 * settings.TARGET_RTT and (not busy or needed < .5 * self.bandwidth) and self.level > 0:
+            self.level -= 1
+            self.level_timer = now
+
+
+def handle_reply(box, capture_ns: int):
+    timing.span("capture_to_reply", capture_ns)
+    latency = (time.perf_counter_ns() - capture_ns) * 1e-9
+    bounds = (box[0], box[2])
+    center_x = np.mean(bounds)
+    # Only do control if received value is valid
+    if bounds[0] == settings.INVALID_VALUE:
+        #print(f"Received yaw error: INVALID")
+        settings.STATE.update(vision_latency=latency, person_bounds=bounds, yaw_err=settings.INVALID_VALUE)
+    else:
+        #print(f"Received L = {bounds[0]}, R = {bounds[1]}, C = {center_x}")
+        # Error is defined as the distance from the center of the image
+        settings.STATE.update(vision_latency=latency, person_bounds=bounds,
+                              yaw_err=int(center_x - settings.IMG_WIDTH / 2), yaw_err_capture_ns=capture_ns)
+        timing.span("capture_to_yaw_err", capture_ns)
+        # We have exited/are not in a stream of invalid values
+        settings.YAW_RESET_TIMER = time.perf_counter()
+        settings.YAW_IS_RESET = False
+        #print(settings.STATE.encoder_count)
+
+
+def receive_replies(connection, stream: Stream, encoder: AdaptiveEncoder):
+    """Thread receiving replies from the server, the newest reply always wins"""
+    try:
+        while True:
+            msg_type, body = protocol.read_message(connection)
+            if msg_type != protocol.REPLY:
+                continue
+            seq, capture_ns, _, box = protocol.parse_reply(body)
+            with stream.cond:
+                # Replies to frames older than the newest answered one are stale
+                if seq <= stream.answered:
+                    continue
+                stream.answered = seq
+                stream.cond.notify_all()
+            handle_reply(box, capture_ns)
+            encoder.on_reply(seq, settings.STATE.vision_latency)
+    except Exception as e:
+        print(f"Error receiving from server: {e}")
+    finally:
+        with stream.cond:
+            stream.closed = True
+            stream.cond.notify_all()
 
 
 def start_client(host: str, port: int):
     # Outer loop trying to establish a connection, catches keyboard interrupts
     try:
         # Create a video capture with correct framerate and 
-        cap = cv2.VideoCapture(0, apiPreference=cv2.CAP_V4L)
+        cap = recorder.open_camera()
         cap.set(cv2.CAP_PROP_FPS, settings.CAM_FPS)
         cap.set(cv2.CAP_PROP_FRAME_WIDTH, settings.IMG_WIDTH)
+        camera = Camera(cap)
+        encoder = AdaptiveEncoder()
+        # Raw frames through shared memory when the server runs on this machine, room for
+        # every frame in flight, as many given up on after a reply timeout that the server
+        # may still have to read, and the one being written
+        sender = shm_transport.SharedMemorySender(2 * settings.MAX_FRAMES_IN_FLIGHT + 1) \
+            if settings.LOCAL_TRANSPORT else None
         while True:
             # Catches connection errors
             try:
                 client_socket = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
                 client_socket.connect((host, port))
-                # Make a file-like object out of the connection for sending data
-                connection = client_socket.makefile('wb')
+                # Make a file-like object out of the connection for receiving replies
+                connection = client_socket.makefile('rb')
             except socket.error as e:
                 print(f"Error while trying to connect: {e}")
                 print("Retrying in 5 seconds...")
                 # When connection is lost, make sure to invalidate all values
-                settings.RANGE = settings.INVALID_VALUE
-                settings.PERSON_BOUNDS = [settings.INVALID_VALUE, settings.INVALID_VALUE]
+                settings.STATE.update(person_bounds=(settings.INVALID_VALUE, settings.INVALID_VALUE))
                 time.sleep(5)
                 continue
-            # Inner loop sending and receiving messages, catches send/receive errors
+            # Replies are received on their own thread
+            stream = Stream()
+            link = LinkMeter(client_socket)
+            threading.Thread(target=receive_replies, args=(connection, stream, encoder), daemon=True).start()
+            # Inner loop sending frames, catches send errors
             try:
+                frame_count = 0
                 while True:
-                    # Capture frame
-                    ret, frame = cap.read()
-                    if not ret:
-                        break
-                    # Encode frame as jpeg
-                    _, buffer = cv2.imencode('.jpg', frame)
-                    # Get the size of the encoded frame
-                    size = len(buffer)
-                    # Send the size of the frame
-                    client_socket.sendall(struct.pack('<L', size))
-                    # Send the frame data
-                    client_socket.sendall(buffer)
-                    #print(f'Sent image of size {size} bytes')
-                    # Receive data from the server
-                    data = client_socket.recv(1024)
-                    # Process received data
-                    if data:
-                        settings.PERSON_BOUNDS = [int(x) for x in data.decode().split(",")]
-                        center_x = np.mean(settings.PERSON_BOUNDS)
-                        # Only do control if received value is valid
-                        if settings.PERSON_BOUNDS[0] == settings.INVALID_VALUE:
-                            #print(f"Received yaw error: INVALID")
-                            settings.YAW_ERR = settings.INVALID_VALUE
-                        else:
-                            #print(f"Received L = {settings.PERSON_BOUNDS[0]}, R = {settings.PERSON_BOUNDS[1]}, C = {center_x}")
-                            # Error is defined as the distance from the center of the image
-                            settings.YAW_ERR = int(center_x - settings.IMG_WIDTH / 2)
-                            # We have exited/are not in a stream of invalid values
-                            settings.YAW_RESET_TIMER = time.perf_counter()
-                            settings.YAW_IS_RESET = False
-                            #print(settings.ENCODER_COUNT)
-                    time.sleep(1/10)
+                    # Wait until there is room for another frame in flight
+                    with stream.cond:
+                        has_room = stream.cond.wait_for(
+                            lambda: stream.sent - stream.answered < settings.MAX_FRAMES_IN_FLIGHT or stream.closed,
+                            timeout=settings.REPLY_TIMEOUT)
+                        if stream.closed:
+                            raise ConnectionError("Connection closed")
+                        # The server drops stale frames without replying, stop waiting for them
+                        if not has_room:
+                            stream.answered = stream.sent
+                    # Get a frame newer than the last one sent
+                    newest = camera.newest(frame_count)
+                    if newest is None:
+                        # Camera failed or the replay log ended, shut down like on Ctrl-C
+                        print("Camera stream ended")
+                        raise KeyboardInterrupt
+                    frame_count, frame, capture_ns = newest
+                    with stream.cond:
+                        stream.sent += 1
+                        seq = stream.sent
+                    if sender is not None:
+                        # Nothing to encode, the raw frame goes through shared memory
+                        send_ns = timing.now()
+                        sender.send(client_socket, seq, capture_ns, frame)
+                        timing.span("send", send_ns)
+                        continue
+                    # Encode frame as jpeg at the current resolution, quality and crop
+                    encode_ns = timing.now()
+                    buffer, transform = encoder.encode(frame, seq)
+                    send_ns = timing.now()
+                    timing.span("encode", encode_ns, send_ns)
+                    # Send the frame with its sequence number, capture time and transform
+                    link.before_send()
+                    protocol.send_frame(client_socket, seq, capture_ns, buffer, transform)
+                    encoder.on_send(link.after_send(len(buffer)))
+                    timing.span("send", send_ns)
+                    #print(f'Sent image of size {len(buffer)} bytes')
                 
             except Exception as e:
                 print(f"Error handling server: {e}")
+                # Shutting down the socket also stops the reply thread
+                try:
+                    client_socket.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
                 client_socket.close()
 
     # Keyboard interrupt is the exit condition, final cleanup is here
     except KeyboardInterrupt:
         print("Client shutting down...")
         settings.SHOULD_EXIT.set()
+        # Unblock the reply thread first, closing its reader while it reads can hang
+        try:
+            client_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
         connection.close()
         client_socket.close()
         cap.release()
+        recorder.close()
+        if sender is not None:
+            sender.close()
 
 if __name__ == "__main__":
-    # Check that the number of arguments is correct
-    if len(sys.argv) != 3:
-        print(f"Usage: python3 {os.path.basename(__file__)} <ipv6-host> <port>")
-        sys.exit(1)
-    
-    # Set host and port
-    host: str = sys.argv[1]
-    port: int = int(sys.argv[2])
-    start_client(host, port)
+    parser = argparse.ArgumentParser(description="Onboard client of the frisbee launcher")
+    parser.add_argument("host", help="IPv6 address of the server")
+    parser.add_argument("port", type=int)
+    parser.add_argument("--record", metavar="FILE", help="log camera frames and serial traffic to FILE")
+    parser.add_argument("--replay", metavar="FILE", help="replay a log instead of using the hardware")
+    parser.add_argument("--speed", type=float, default=1., help="replay speed factor")
+    parser.add_argument("--loop", action="store_true", help="loop the replay log")
+    parser.add_argument("--duration", type=float, help="shut down after this many seconds")
+    parser.add_argument("--local", action="store_true",
+                        help="pass raw frames through shared memory to a server on this machine")
+    parser.add_argument("--set", metavar="NAME=VALUE", action="append", default=[],
+                        help="override a setting, e.g. --set MAX_FRAMES_IN_FLIGHT=1")
+    args = parser.parse_args()
+    settings.RECORD_FILE = args.record
+    settings.REPLAY_FILE = args.replay
+    settings.REPLAY_SPEED = args.speed
+    settings.REPLAY_LOOP = args.loop
+    settings.LOCAL_TRANSPORT = settings.LOCAL_TRANSPORT or args.local
+    for override in args.set:
+        name, sep, value = override.partition("=")
+        if not sep:
+            parser.error(f"--set {override}: expected NAME=VALUE")
+        # A typo would otherwise silently create a setting nothing reads
+        if not hasattr(settings, name):
+            parser.error(f"--set {override}: no setting named {name}")
+        try:
+            setattr(settings, name, ast.literal_eval(value))
+        except (ValueError, SyntaxError):
+            parser.error(f"--set {override}: {value} is not a Python literal")
+    if args.duration is not None:
+        # Shut down through the same path as Ctrl-C
+        threading.Timer(args.duration, _thread.interrupt_main).start()
+
+    # Start the range sensor and ESP32 threads
+    range_thread = threading.Thread(target=mc.range_sensor_thread)
+    esp32_thread = threading.Thread(target=mc.esp32_thread)
+    # Set the threads as daemons so they exit when the main thread exits
+    range_thread.daemon = True
+    esp32_thread.daemon = True
+    range_thread.start()
+    esp32_thread.start()
+    # Periodically write the latency histograms if enabled
+    timing_thread = timing.start("client")
+
+    start_client(args.host, args.port)
     range_thread.join()
     esp32_thread.join()
+    if timing_thread is not None:
+        timing_thread.join()
     print("Exited all threads successfully")
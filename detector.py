@@ -0,0 +1,308 @@
+import os
+import time
+import argparse
+import cv2
+import numpy as np
+
+import settings
+
+# Backends selectable with settings.DETECTOR_BACKEND / server.py --backend
+BACKENDS = ("ultralytics", "onnx", "openvino")
+# COCO class of persons, the only class we detect
+PERSON = 0
+# Padding value of letterboxed images, same as ultralytics
+PAD_VALUE = 114
+
+
+class Detector():
+    """Person detector, predict returns one array of [x0, y0, x1, y1, score, class] rows per image"""
+    name = None
+
+    def predict(self, images) -> list:
+        raise NotImplementedError
+
+    def warm_up(self, runs: int):
+        """Run a few inferences so lazy initialization and allocations happen before serving"""
+        image = np.full((settings.IMG_WIDTH * 3 // 4, settings.IMG_WIDTH, 3), PAD_VALUE, dtype=np.uint8)
+        for _ in range(runs):
+            self.predict([image])
+        # Also the largest batch the server can form
+        self.predict([image] * settings.MAX_CLIENTS)
+
+
+class UltralyticsDetector(Detector):
+    """The PyTorch model through ultralytics, the reference the exported backends are compared against"""
+    name = "ultralytics"
+
+    def __init__(self, weights: str, imgsz: int, threads: int = 0):
+        from ultralytics import YOLO
+        if threads:
+            import torch
+            torch.set_num_threads(threads)
+        self.model = YOLO(weights)
+        self.imgsz = imgsz
+
+    def predict(self, images) -> list:
+        results = self.model.predict(images, classes=[PERSON], imgsz=self.imgsz, conf=settings.DETECTOR_CONF,
+                                     iou=settings.DETECTOR_IOU, verbose=False)
+        return [result.boxes.data.cpu().numpy() for result in results]
+
+
+class ExportedDetector(Detector):
+    """
+    Runs an exported YOLOv8 graph directly, without PyTorch. Letterboxing, box
+    decoding and NMS are done here with NumPy and OpenCV.
+    """
+    def __init__(self, imgsz: int):
+        self.imgsz = imgsz
+        # Input batch, reused between calls and grown when needed
+        self.batch = np.empty((0, 3, imgsz, imgsz), dtype=np.float32)
+
+    def run(self, batch: np.ndarray) -> np.ndarray:
+        """Raw model output (batch, 4 + classes, anchors) for a float32 NCHW batch"""
+        raise NotImplementedError
+
+    def predict(self, images) -> list:
+        if len(images) > len(self.batch):
+            self.batch = np.empty((len(images), 3, self.imgsz, self.imgsz), dtype=np.float32)
+        batch = self.batch[:len(images)]
+        transforms = [letterbox(image, self.imgsz, out) for image, out in zip(images, batch)]
+        output = self.run(batch)
+        return [postprocess(prediction, image.shape, transform)
+                for prediction, image, transform in zip(output, images, transforms)]
+
+
+class OnnxDetector(ExportedDetector):
+    """ONNX Runtime on the CPU, FP32 or dynamically quantized INT8"""
+    name = "onnx"
+
+    def __init__(self, path: str, imgsz: int, threads: int = 0):
+        super().__init__(imgsz)
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def run(self, batch: np.ndarray) -> np.ndarray:
+        return self.session.run(None, {self.input_name: batch})[0]
+
+
+class OpenVinoDetector(ExportedDetector):
+    """OpenVINO on the CPU, FP32 or INT8 (post-training quantized during export)"""
+    name = "openvino"
+
+    def __init__(self, path: str, imgsz: int, threads: int = 0):
+        super().__init__(imgsz)
+        import openvino as ov
+        config = {"PERFORMANCE_HINT": "LATENCY"}
+        if threads:
+            config["INFERENCE_NUM_THREADS"] = threads
+        core = ov.Core()
+        self.model = core.compile_model(core.read_model(path), "CPU", config)
+        self.output = self.model.output(0)
+
+    def run(self, batch: np.ndarray) -> np.ndarray:
+        return self.model(batch)[self.output]
+
+
+def letterbox(image: np.ndarray, imgsz: int, out: np.ndarray):
+    """
+    Scale to fit an imgsz square keeping the aspect ratio and pad, written into
+    out as CHW float32 RGB. Returns the (scale, pad_x, pad_y) to map boxes back.
+    """
+    height, width = image.shape[:2]
+    scale = min(imgsz / height, imgsz / width)
+    new_width, new_height = round(width * scale), round(height * scale)
+    pad_x, pad_y = (imgsz - new_width) // 2, (imgsz - new_height) // 2
+    resized = cv2.resize(image, (new_width, new_height), interpolation=cv2.INTER_LINEAR)
+    out[...] = PAD_VALUE / 255.
+    # BGR HWC uint8 to RGB CHW [0, 1]
+    np.multiply(resized[:, :, ::-1].transpose(2, 0, 1), 1. / 255.,
+                out=out[:, pad_y:pad_y + new_height, pad_x:pad_x + new_width], casting="unsafe")
+    return scale, pad_x, pad_y
+
+
+def postprocess(prediction: np.ndarray, shape, transform) -> np.ndarray:
+    """Person boxes in image pixels from one raw (4 + classes, anchors) prediction"""
+    scale, pad_x, pad_y = transform
+    scores = prediction[4 + PERSON]
+    keep = scores > settings.DETECTOR_CONF
+    if not np.any(keep):
+        return np.zeros((0, 6), dtype=np.float32)
+    cx, cy, w, h = prediction[:4, keep]
+    scores = scores[keep]
+    boxes = np.stack([cx - w / 2, cy - h / 2, w, h], axis=1)
+    kept = np.asarray(cv2.dnn.NMSBoxes(boxes.tolist(), scores.tolist(), settings.DETECTOR_CONF,
+                                       settings.DETECTOR_IOU), dtype=int).reshape(-1)
+    boxes, scores = boxes[kept], scores[kept]
+    # Undo the letterbox and clip to the image
+    x0 = np.clip((boxes[:, 0] - pad_x) / scale, 0, shape[1])
+    y0 = np.clip((boxes[:, 1] - pad_y) / scale, 0, shape[0])
+    x1 = np.clip((boxes[:, 0] + boxes[:, 2] - pad_x) / scale, 0, shape[1])
+    y1 = np.clip((boxes[:, 1] + boxes[:, 3] - pad_y) / scale, 0, shape[0])
+    return np.stack([x0, y0, x1, y1, scores, np.full_like(scores, PERSON)], axis=1).astype(np.float32)
+
+
+def _is_cached(path: str, weights: str) -> bool:
+    """Whether an export exists and is newer than the weights it was made from"""
+    return os.path.exists(path) and (not os.path.exists(weights)
+                                     or os.path.getmtime(path) >= os.path.getmtime(weights))
+
+
+def export_model(weights: str, backend: str, imgsz: int, int8: bool = False) -> str:
+    """
+    Export the weights for a backend once and cache the result next to them,
+    named by input size and precision. Returns the path the backend loads.
+    """
+    stem = f"{os.path.splitext(weights)[0]}_{imgsz}{'_int8' if int8 else ''}"
+    if backend == "onnx":
+        path = f"{stem}.onnx"
+        if _is_cached(path, weights):
+            return path
+        fp32_path = export_model(weights, backend, imgsz) if int8 else path
+        if int8:
+            from onnxruntime.quantization import quantize_dynamic, QuantType
+            print(f"Quantizing {fp32_path} to {path}")
+            quantize_dynamic(fp32_path, path, weight_type=QuantType.QUInt8)
+            return path
+    elif backend == "openvino":
+        path = f"{stem}_openvino_model"
+        if _is_cached(path, weights):
+            return os.path.join(path, f"{os.path.basename(os.path.splitext(weights)[0])}.xml")
+    else:
+        raise ValueError(f"Backend {backend} needs no export")
+
+    from ultralytics import YOLO
+    print(f"Exporting {weights} for {backend} at input size {imgsz}")
+    # Dynamic shapes so the server can run batches of any size
+    exported = YOLO(weights).export(format=backend, imgsz=imgsz, dynamic=True, int8=int8)
+    os.replace(str(exported).rstrip("/\\"), path)
+    return export_model(weights, backend, imgsz, int8)
+
+
+def load_detector(backend: str = None, weights: str = None, imgsz: int = None, threads: int = None,
+                  int8: bool = None) -> Detector:
+    """Create a detector, unspecified arguments come from settings"""
+    backend = backend or settings.DETECTOR_BACKEND
+    weights = weights or settings.DETECTOR_WEIGHTS
+    imgsz = imgsz or settings.DETECTOR_IMGSZ
+    threads = settings.DETECTOR_THREADS if threads is None else threads
+    int8 = settings.DETECTOR_INT8 if int8 is None else int8
+    if backend == "ultralytics":
+        return UltralyticsDetector(weights, imgsz, threads)
+    path = export_model(weights, backend, imgsz, int8)
+    if backend == "onnx":
+        return OnnxDetector(path, imgsz, threads)
+    return OpenVinoDetector(path, imgsz, threads)
+
+
+def read_frames(path: str, limit: int):
+    """Frames of a client.py --record log, or of anything OpenCV can open as video"""
+    frames = []
+    if path.endswith(".log"):
+        import recorder
+        for _, data in recorder.ReplayLog(path).records[recorder.CAMERA][:limit]:
+            frames.append(cv2.imdecode(np.frombuffer(data, dtype=np.uint8), 1))
+        return frames
+    cap = cv2.VideoCapture(path)
+    while len(frames) < limit:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        frames.append(frame)
+    cap.release()
+    return frames
+
+
+def target_box(detections: np.ndarray):
+    """The box the server would reply with: only when exactly one person is detected"""
+    return detections[0, :4] if len(detections) == 1 else None
+
+
+def iou(a, b) -> float:
+    width = max(0., min(a[2], b[2]) - max(a[0], b[0]))
+    height = max(0., min(a[3], b[3]) - max(a[1], b[1]))
+    intersection = width * height
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - intersection
+    return intersection / union if union > 0 else 0.
+
+
+def benchmark(detector: Detector, frames, reference) -> dict:
+    """
+    Per-frame latency of a detector, and how often it leads to the same reply
+    as the reference detections (same person/no person decision, IoU >= .5)
+    """
+    latencies, ious = [], []
+    agree = 0
+    for frame, expected in zip(frames, reference):
+        start = time.perf_counter()
+        detections = detector.predict([frame])[0]
+        latencies.append(time.perf_counter() - start)
+        box, expected_box = target_box(detections), target_box(expected)
+        if box is None or expected_box is None:
+            agree += box is None and expected_box is None
+        else:
+            ious.append(iou(box, expected_box))
+            agree += ious[-1] >= .5
+    latencies = np.array(latencies) * 1e3
+    return {
+        "mean_ms": float(np.mean(latencies)),
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p95_ms": float(np.percentile(latencies, 95)),
+        "agreement_%": 100. * agree / len(frames),
+        "mean_iou": float(np.mean(ious)) if ious else float("nan"),
+    }
+
+
+def main():
+    settings.init()
+    parser = argparse.ArgumentParser(description="Export person detection backends and benchmark them")
+    parser.add_argument("command", choices=("export", "benchmark"))
+    parser.add_argument("source", nargs="?", help="recorded log or video to benchmark on")
+    parser.add_argument("--backend", action="append", choices=BACKENDS,
+                        help="backends to export/benchmark (default: onnx)")
+    parser.add_argument("--weights", default=settings.DETECTOR_WEIGHTS)
+    parser.add_argument("--imgsz", type=int, default=settings.DETECTOR_IMGSZ, help="model input size")
+    parser.add_argument("--threads", type=int, default=settings.DETECTOR_THREADS, help="0: runtime default")
+    parser.add_argument("--int8", action="store_true", help="also use INT8 variants")
+    parser.add_argument("--frames", type=int, default=200, help="maximum number of frames to benchmark on")
+    parser.add_argument("--warmup", type=int, default=settings.DETECTOR_WARMUP)
+    args = parser.parse_args()
+
+    backends = args.backend or ["onnx"]
+    variants = [(backend, int8) for backend in backends for int8 in ((False, True) if args.int8 else (False,))
+                if backend != "ultralytics" or not int8]
+    if args.command == "export":
+        for backend, int8 in variants:
+            if backend != "ultralytics":
+                print(export_model(args.weights, backend, args.imgsz, int8))
+        return
+
+    if args.source is None:
+        parser.error("benchmark needs a source log or video")
+    frames = read_frames(args.source, args.frames)
+    if not frames:
+        parser.error(f"no frames in {args.source}")
+    reference_detector = load_detector("ultralytics", args.weights, args.imgsz, args.threads)
+    reference_detector.warm_up(args.warmup)
+    reference = [reference_detector.predict([frame])[0] for frame in frames]
+    results = {"ultralytics": benchmark(reference_detector, frames, reference)}
+    for backend, int8 in variants:
+        if backend == "ultralytics":
+            continue
+        detector = load_detector(backend, args.weights, args.imgsz, args.threads, int8)
+        detector.warm_up(args.warmup)
+        results[f"{backend}{'-int8' if int8 else ''}"] = benchmark(detector, frames, reference)
+
+    print(f"{len(frames)} frames, input size {args.imgsz}, {args.threads or 'default'} threads")
+    columns = list(results["ultralytics"])
+    print(f"{'backend':>14}  " + "  ".join(f"{c:>12}" for c in columns))
+    for name, row in results.items():
+        print(f"{name:>14}  " + "  ".join(f"{row[c]:>12.2f}" for c in columns))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+import cv2
+import numpy as np
+
+import settings
+
+# Lucas-Kanade parameters
+LK_PARAMS = dict(winSize=(15, 15), maxLevel=2,
+                 criteria=(cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 10, .03))
+
+
+class FlowTracker():
+    """
+    Follows a single target box between detections with sparse Lucas-Kanade
+    optical flow. Points and the box are kept in full frame pixels, so
+    consecutive images may be cropped and scaled differently by the client.
+    """
+    def __init__(self):
+        self.box = None
+        # Tracked points [full frame px], the previous grayscale image and its transform
+        self.points = None
+        self.gray = None
+        self.transform = None
+        # Share of points that survived the last update
+        self.confidence = 0.
+
+    @property
+    def active(self) -> bool:
+        return self.box is not None
+
+    def start(self, gray, transform, box):
+        """Start following a box [full frame px] detected in the grayscale image"""
+        self.box = np.array(box, dtype=np.float32)
+        self.gray = gray
+        self.transform = transform
+        self.points = self._seed(gray, transform)
+        self.confidence = 1.
+        if len(self.points) < settings.FLOW_MIN_POINTS:
+            self.stop()
+
+    def stop(self):
+        self.box = None
+        self.points = None
+        self.gray = None
+
+    def update(self, gray, transform):
+        """The box [full frame px] in a new grayscale image, None (and stopped) when the target is lost"""
+        if not self.active:
+            return None
+        prev = self.gray
+        # Bring the previous image into the pixel coordinates of the new one
+        warp = _warp(self.transform, transform)
+        if warp is not None:
+            prev = cv2.warpAffine(prev, warp, (gray.shape[1], gray.shape[0]))
+        old = to_image(self.points, transform).reshape(-1, 1, 2)
+        new, status, _ = cv2.calcOpticalFlowPyrLK(prev, gray, old, None, **LK_PARAMS)
+        back, back_status, _ = cv2.calcOpticalFlowPyrLK(gray, prev, new, None, **LK_PARAMS)
+        # Keep points that track back to where they started
+        error = np.linalg.norm((back - old).reshape(-1, 2), axis=1)
+        good = (status.ravel() == 1) & (back_status.ravel() == 1) & (error < settings.FLOW_FB_ERROR)
+        self.confidence = np.count_nonzero(good) / len(good)
+        if np.count_nonzero(good) < settings.FLOW_MIN_POINTS or self.confidence < settings.FLOW_MIN_CONFIDENCE:
+            self.stop()
+            return None
+
+        old_points = self.points[good]
+        new_points = to_full_frame(new.reshape(-1, 2)[good], transform)
+        # Move the box with the median motion and scale it with the median spread change
+        shift = np.median(new_points - old_points, axis=0)
+        old_spread = np.linalg.norm(old_points - np.median(old_points, axis=0), axis=1)
+        new_spread = np.linalg.norm(new_points - np.median(new_points, axis=0), axis=1)
+        valid = old_spread > 1.
+        zoom = float(np.median(new_spread[valid] / old_spread[valid])) if np.any(valid) else 1.
+        center = (self.box[:2] + self.box[2:]) / 2 + shift
+        half_size = (self.box[2:] - self.box[:2]) / 2 * zoom
+        self.box = np.concatenate([center - half_size, center + half_size])
+
+        self.points = new_points
+        self.gray = gray
+        self.transform = transform
+        # Top up the points when many were lost
+        if len(self.points) < settings.FLOW_MAX_POINTS // 2:
+            self.points = np.concatenate([self.points, self._seed(gray, transform)])
+        return self.box
+
+    def _seed(self, gray, transform):
+        """Good features to track inside the box, in full frame pixels"""
+        x0, y0, x1, y1 = to_image(self.box.reshape(2, 2), transform).ravel()
+        mask = np.zeros_like(gray)
+        mask[max(int(y0), 0):max(int(y1), 0), max(int(x0), 0):max(int(x1), 0)] = 255
+        corners = cv2.goodFeaturesToTrack(gray, settings.FLOW_MAX_POINTS, .01, 5, mask=mask)
+        if corners is None:
+            return np.zeros((0, 2), dtype=np.float32)
+        return to_full_frame(corners.reshape(-1, 2), transform)
+
+
+def to_full_frame(points, transform):
+    """Map (n, 2) points in a sent image to full frame pixels"""
+    offset_x, offset_y, scale = transform
+    return (points / scale + np.array([offset_x, offset_y], dtype=np.float32)).astype(np.float32)
+
+
+def to_image(points, transform):
+    """Map (n, 2) points in full frame pixels to a sent image"""
+    offset_x, offset_y, scale = transform
+    return ((points - np.array([offset_x, offset_y], dtype=np.float32)) * scale).astype(np.float32)
+
+
+def _warp(source, target):
+    """Affine map from the pixels of one sent image to another, None if they are the same"""
+    if source == target:
+        return None
+    (source_x, source_y, source_scale), (target_x, target_y, target_scale) = source, target
+    zoom = target_scale / source_scale
+    return np.array([[zoom, 0., (source_x - target_x) * target_scale],
+                     [0., zoom, (source_y - target_y) * target_scale]], dtype=np.float32)
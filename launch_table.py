@@ -0,0 +1,143 @@
+import hashlib
+import os
+import sys
+import zipfile
+import numpy as np
+
+import settings
+
+# Simulator parameters the (Euler, simulate_batch) table depends on
+PHYSICS_PARAMS = ("g", "mass", "rho", "area", "cl0", "cla", "cd0", "cda", "alpha0", "dt", "x0", "y0")
+
+
+def launch_settings() -> dict:
+    """The launcher settings a table is generated for, saved with it and checked on load"""
+    return {"launch_angle": settings.LAUNCH_ANGLE, "max_launch_speed": settings.MAX_LAUNCH_SPEED,
+            "fire_command_min": settings.FIRE_COMMAND_MIN, "fire_command_max": settings.FIRE_COMMAND_MAX}
+
+
+class LaunchTable():
+    """
+    Range-to-launch-command table on a uniform distance grid, so a lookup is
+    a single index computation plus a linear interpolation
+    """
+    def __init__(self, dist_min: float, dist_step: float, speeds, commands, key: str, launch: dict):
+        self.dist_min = dist_min
+        self.dist_step = dist_step
+        self.speeds = speeds
+        self.commands = commands
+        self.key = key
+        # Launcher settings the table was generated for, see launch_settings()
+        self.launch = launch
+
+    def lookup(self, distance: float) -> int:
+        """Interpolated launch command for a target distance [m], clamped to the table"""
+        pos = (distance - self.dist_min) / self.dist_step
+        pos = min(max(pos, 0.), len(self.commands) - 1.)
+        i = min(int(pos), len(self.commands) - 2)
+        frac = pos - i
+        return int(round(self.commands[i] + frac * (self.commands[i + 1] - self.commands[i])))
+
+    def lookup_array(self, distances):
+        """Vectorized lookup for an array of target distances [m]"""
+        grid = self.dist_min + self.dist_step * np.arange(len(self.commands))
+        return np.rint(np.interp(distances, grid, self.commands)).astype(int)
+
+
+def speed_to_command(speed):
+    """Map launch speed [m/s] to the firing motor command (assumed linear, needs calibration)"""
+    command = settings.FIRE_COMMAND_MIN + \
+        (settings.FIRE_COMMAND_MAX - settings.FIRE_COMMAND_MIN) * np.asarray(speed) / settings.MAX_LAUNCH_SPEED
+    return np.clip(np.rint(command), settings.FIRE_COMMAND_MIN, settings.FIRE_COMMAND_MAX).astype(np.int16)
+
+
+def command_to_speed(command):
+    """Launch speed [m/s] of a firing motor command, inverse of speed_to_command"""
+    return settings.MAX_LAUNCH_SPEED * (np.asarray(command) - settings.FIRE_COMMAND_MIN) \
+        / (settings.FIRE_COMMAND_MAX - settings.FIRE_COMMAND_MIN)
+
+
+def table_key(sim) -> str:
+    """Short hash of the simulator parameters the table depends on"""
+    params = [(name, getattr(sim, name)) for name in PHYSICS_PARAMS]
+    return hashlib.sha1(repr(params).encode()).hexdigest()[:12]
+
+
+def build_table(sim=None, num_speeds: int = 400, num_dists: int = 256) -> LaunchTable:
+    """
+    Sweep launch speeds at the fixed launch angle with the simulator and invert
+    the result onto a uniform distance grid
+    """
+    # Only needed on the machine generating the table
+    from simulation.main import FrisbeeSimulator
+    if sim is None:
+        sim = FrisbeeSimulator()
+    speeds = np.linspace(1., settings.MAX_LAUNCH_SPEED, num=num_speeds)
+    dists = sim.simulate_batch(speeds, settings.LAUNCH_ANGLE)
+    # Only keep the part where distance increases with speed, so it can be inverted
+    last = int(np.argmax(dists)) + 1
+    speeds, dists = speeds[:last], dists[:last]
+    grid, dist_step = np.linspace(dists[0], dists[-1], num=num_dists, retstep=True)
+    grid_speeds = np.interp(grid, dists, speeds)
+    return LaunchTable(float(grid[0]), float(dist_step), grid_speeds, speed_to_command(grid_speeds).tolist(),
+                       table_key(sim), launch_settings())
+
+
+def cached_table(path: str, sim=None):
+    """The table in the file at path if it was generated with the same parameters and settings, else None"""
+    from simulation.main import FrisbeeSimulator
+    if sim is None:
+        sim = FrisbeeSimulator()
+    if not os.path.exists(path):
+        return None
+    try:
+        table = load_table(path)
+    except ValueError as e:
+        print(f"Ignoring launch table ({e})")
+        return None
+    return table if table.key == table_key(sim) else None
+
+
+def generate_table(path: str, sim=None, num_speeds: int = 400, num_dists: int = 256) -> LaunchTable:
+    """Build the table and save it to path, reusing the file if it was generated with the same parameters"""
+    table = cached_table(path, sim)
+    if table is None:
+        table = build_table(sim, num_speeds, num_dists)
+        save_table(path, table)
+    return table
+
+
+def save_table(path: str, table: LaunchTable):
+    np.savez(path, dist_min=table.dist_min, dist_step=table.dist_step, speeds=table.speeds,
+             commands=np.asarray(table.commands, dtype=np.int16), key=table.key, **table.launch)
+
+
+def load_table(path: str) -> LaunchTable:
+    """
+    Raises OSError if the file can't be read and ValueError if it isn't a valid
+    table or was generated for other launcher settings
+    """
+    try:
+        with np.load(path) as data:
+            table = LaunchTable(float(data["dist_min"]), float(data["dist_step"]),
+                                data["speeds"], data["commands"].tolist(), str(data["key"]),
+                                {name: data[name].item() for name in launch_settings()})
+    except (KeyError, zipfile.BadZipFile) as e:
+        raise ValueError(f"Invalid launch table {path}: {e}") from e
+    if len(table.commands) < 2 or not table.dist_step > 0:
+        raise ValueError(f"Invalid launch table {path}")
+    mismatch = [f"{name} {value} (settings: {settings_value})"
+                for (name, value), settings_value in zip(table.launch.items(), launch_settings().values())
+                if value != settings_value]
+    if mismatch:
+        raise ValueError(f"Launch table {path} was generated for other settings: {', '.join(mismatch)}")
+    return table
+
+
+if __name__ == "__main__":
+    path = sys.argv[1] if len(sys.argv) > 1 else settings.LAUNCH_TABLE_FILE
+    # Settings are needed for the launch angle and command limits
+    settings.init()
+    table = generate_table(path)
+    print(f"Launch table {table.key} covering {table.dist_min:.2f} - "
+          f"{table.dist_min + table.dist_step * (len(table.commands) - 1):.2f} m saved to {path}")
@@ -1,61 +1,39 @@
 import numpy as np
 import time
-from serial import Serial
+import threading
 
 import settings
+import timing
+import recorder
+import range_sensor
+from target_filter import TargetFilter
 
 
 def range_sensor_thread():
     """Thread for taking measurements from the range sensor serial port"""
     try:
         # Open serial port
-        range_ser = Serial(settings.RANGE_FILE, baudrate=9600)
+        range_ser = recorder.open_serial("range", settings.RANGE_FILE, baudrate=9600)
         range_ser.timeout = 1.
+        parser = range_sensor.RangeParser()
+        settings.RANGE_VALS = range_sensor.RangeRing(settings.RANGE_RING_SIZE)
         while True:
-            # Create a byte array to store received data
-            data = bytearray(11)
-            # Read 11 bytes of data from the serial port
-            for i in range(11):
-                byte = range_ser.read()
-                if len(byte) == 0:
-                    break
-                data[i] = ord(byte)
-            # Calculate distance based on received data
-            distance : float = (data[3] - 0x30) * 100 + (data[4] - 0x30) * 10 + (data[5] - 0x30) * 1 + \
-                    (data[7] - 0x30) * 0.1 + (data[8] - 0x30) * 0.01 + (data[9] - 0x30) * 0.001
-            # Check for bogus value
-            if distance > 100 or distance < 0 or np.isnan(distance):
-                distance = settings.INVALID_VALUE
-                #print("Distance measurement: INVALID")
-            else:
-                #print(f"Distance measurement: {distance}")
-                pass
-            
-            # Save the distance value
-            settings.RANGE = distance
-
-            # Calculate person width (NOTE: evaluates to zero if invalid)
-            #person_width = settings.PERSON_BOUNDS[1] - settings.PERSON_BOUNDS[0]
-            #print(settings.YAW_ERR)
-            # Check if yaw error is within bounds
-            if not settings.FIRE_REQUEST \
-               and time.perf_counter() > settings.FIRE_TIMER + settings.FIRE_COOLDOWN \
-               and abs(settings.YAW_ERR) < 10 \
-               and settings.RANGE != settings.INVALID_VALUE:
-                #and person_width > 0 \
-                #and abs(settings.YAW_ERR) < settings.GET_RANGE_PROP * person_width:
-                # Gather range measurements and save to list
-                settings.RANGE_VALS.append(settings.RANGE)
-                print(f"Gathered range measurement {settings.RANGE}")
-                # When sufficiently many measurements, initiate firing sequence
-                if len(settings.RANGE_VALS) >= settings.SUFF_NUM_MEAS:
-                    print("Firing request")
-                    # Compute the PWM value here!
-                    settings.FIRE_COMMAND = 70
-                    settings.FIRE_REQUEST = True
-            # If a single frame does not fulfill conditions, reset
-            else:
-                settings.RANGE_VALS.clear()
+            # Read everything waiting (at least one frame) in one call, a timeout returns less
+            data = range_ser.read(max(range_ser.in_waiting, range_sensor.FRAME_LEN))
+            distances = parser.feed(data)
+            # Nothing received in time counts as an invalid measurement
+            if not data:
+                distances = [settings.INVALID_VALUE]
+            for distance in distances:
+                # Check for bogus value
+                if distance > 100 or distance < 0 or np.isnan(distance):
+                    distance = settings.INVALID_VALUE
+                    #print("Distance measurement: INVALID")
+                else:
+                    #print(f"Distance measurement: {distance}")
+                    pass
+
+                update_range_vals(distance)
 
             # Exit when exit flag is true
             if settings.SHOULD_EXIT.is_set():
@@ -71,53 +49,57 @@ def range_sensor_thread():
         print("Range port closed")
 
 
+def update_range_vals(distance: float):
+    """Gather a range measurement while aimed at the person, and request firing"""
+    # Read the vision and firing state as one consistent view
+    snapshot = settings.STATE.snapshot("fire_request", "yaw_err", "person_bounds")
+    fire_request, yaw_err, person_bounds = snapshot
+    # Calculate person width (NOTE: evaluates to zero if invalid)
+    #person_width = person_bounds[1] - person_bounds[0]
+    #print(yaw_err)
+    # Check if yaw error is within bounds (and recent enough to pair with this range),
+    # the cooldown runs from when the last firing request was cleared
+    if fire_request is None \
+       and snapshot.age("fire_request") > settings.FIRE_COOLDOWN \
+       and abs(yaw_err) < 10 \
+       and snapshot.fresh("yaw_err", settings.YAW_ERR_MAX_AGE) \
+       and distance != settings.INVALID_VALUE:
+        #and person_width > 0 \
+        #and abs(yaw_err) < settings.GET_RANGE_PROP * person_width:
+        # Gather range measurements in the ring buffer
+        settings.RANGE_VALS.append(distance)
+        print(f"Gathered range measurement {distance}")
+        # When sufficiently many consistent measurements, initiate firing sequence
+        if settings.RANGE_VALS.num_inliers(settings.RANGE_OUTLIER_TOL) >= settings.SUFF_NUM_MEAS:
+            print("Firing request")
+            settings.STATE.fire_request = fire_command(settings.RANGE_VALS.robust_mean(settings.RANGE_OUTLIER_TOL))
+    # If a single frame does not fulfill conditions, reset
+    else:
+        settings.RANGE_VALS.clear()
+
+
 def esp32_thread():
+    """Thread reading encoder counts and firing status from the ESP32, runs the yaw controller on its own thread"""
     try:
         # Connect to ESP32 via serial port
-        esp32_ser = Serial(settings.ESP32_FILE, baudrate=115200, timeout=0.1)
+        esp32_ser = recorder.open_serial("esp32", settings.ESP32_FILE, baudrate=115200, timeout=0.1)
         esp32_ser.write("r\n".encode())
-        request_sent = False
-        # Communicating with ESP32
-        while True:
-            # Check for exit flag
-            if settings.SHOULD_EXIT.is_set():
-                # Reset yaw position
-                esp32_ser.write("r\n".encode())
-                # Set motor to neutral
-                esp32_ser.write(f"y{settings.MOTOR_NEUTRAL}\n".encode())
-                break
-            
-            # Read from the ESP32
+        control_thread = threading.Thread(target=yaw_control_thread, args=(esp32_ser,), daemon=True)
+        control_thread.start()
+        # Reading from the ESP32 until the exit flag is set
+        while not settings.SHOULD_EXIT.is_set():
             data = esp32_ser.readline().decode().strip()
-            # Reset firing flags when firing sequence is finished
-
+            # Clear the firing request when firing sequence is finished, starts the cooldown
             if data == "f":
                 print("Firing finished")
-                settings.FIRE_REQUEST = False
-                request_sent = False
-                settings.FIRE_TIMER = time.perf_counter()
-            
-            # Incase fire request, perform firing sequence, skip rest of the loop
-            if request_sent:
-                continue
-            if settings.FIRE_REQUEST and not request_sent:
-                #print(f"Sent request with average distance {np.mean(settings.RANGE_VALS)}")
-                #esp32_ser.write(f"f{settings.FIRE_COMMAND}".encode())
-                request_sent = True
+                settings.STATE.fire_request = None
                 continue
-            
             # Update encoder count
             try:
-                settings.ENCODER_COUNT = int(data)
+                settings.STATE.encoder_count = int(data)
             except ValueError:
                 pass
-            # Update yaw command
-            yaw_control()
-            #print(settings.ENCODER_COUNT)
-            #print(f"Sent yaw command {settings.YAW_CONTROL}")
-            esp32_ser.write(f"y{settings.YAW_CONTROL}\n".encode())
-
-            
+        control_thread.join()
     
     except Exception as e:
        print(f"Exception thrown in ESP32 thread: {e}")
@@ -127,6 +109,70 @@ def esp32_thread():
             esp32_ser.close()
             esp32_ser.write("f153".encode())
         print("ESP32 port closed")
+
+
+def yaw_control_thread(esp32_ser):
+    """
+    Runs yaw_control at the fixed rate settings.YAW_CONTROL_RATE with the measured
+    timestep, only sending commands that changed plus a periodic keepalive
+    """
+    period = 1. / settings.YAW_CONTROL_RATE
+    if settings.TARGET_PREDICTION:
+        settings.TARGET_FILTER = TargetFilter(settings.YAW_PX_PER_COUNT, settings.TARGET_ACCEL_NOISE,
+                                              settings.TARGET_MEAS_NOISE, settings.TARGET_VEL_VAR,
+                                              settings.TARGET_MAX_HORIZON)
+    request_sent = False
+    # Last command sent and when
+    last_command = None
+    last_send = 0.
+    # Capture time of the frame behind the last timed yaw command sent
+    timed_capture_ns = 0
+    try:
+        prev_tick = next_tick = time.perf_counter()
+        while not settings.SHOULD_EXIT.is_set():
+            next_tick += period
+            delay = next_tick - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                # Fell behind, don't try to catch up with a burst of ticks
+                next_tick = time.perf_counter()
+            now = time.perf_counter()
+            dt = now - prev_tick
+            prev_tick = now
+
+            # Incase fire request, perform firing sequence, no yaw control until it is finished
+            fire_request = settings.STATE.fire_request
+            if fire_request is not None:
+                if not request_sent:
+                    #print(f"Sent request with average distance {settings.RANGE_VALS.robust_mean(settings.RANGE_OUTLIER_TOL)}")
+                    #esp32_ser.write(f"f{fire_request}".encode())
+                    request_sent = True
+                continue
+            request_sent = False
+
+            # Update yaw command
+            capture_ns = settings.STATE.yaw_err_capture_ns
+            command = yaw_control(dt)
+            if command != last_command or now > last_send + settings.YAW_KEEPALIVE:
+                #print(f"Sent yaw command {command}")
+                esp32_ser.write(f"y{command}\n".encode())
+                last_command = command
+                last_send = now
+                # Time the first command sent after every new yaw error
+                if capture_ns != timed_capture_ns:
+                    timed_capture_ns = capture_ns
+                    timing.span("capture_to_motor", capture_ns)
+    except Exception as e:
+        print(f"Exception thrown in yaw control thread: {e}")
+        # No yaw control without this thread, shut everything down
+        settings.SHOULD_EXIT.set()
+    # Stop the motor however the loop ended
+    finally:
+        # Reset yaw position
+        esp32_ser.write("r\n".encode())
+        # Set motor to neutral
+        esp32_ser.write(f"y{settings.MOTOR_NEUTRAL}\n".encode())
         
 
 def positive_yaw_pwm_map(percentage: float) -> int:
@@ -137,40 +183,82 @@ def negative_yaw_pwm_map(percentage: float) -> int:
     """Map to actual duty cycle value for negative rotation from a 0-100 range"""
     return int(160 + 0.12 * percentage) if percentage > 3 else settings.MOTOR_NEUTRAL
 
-def yaw_control():
-    # If invalid value, no control
-    if settings.YAW_ERR == settings.INVALID_VALUE:
-        settings.YAW_CONTROL = settings.MOTOR_NEUTRAL
-        return
-    
+def yaw_control(dt: float = None) -> int:
+    """
+    PID control of the yaw from the pixel error. The I and D terms are scaled
+    to the timestep settings.YAW_GAIN_DT the gains are tuned for, using the
+    measured timestep dt [s] and the capture times of the vision samples.
+    With settings.TARGET_FILTER, P and I act on the error predicted to now.
+    Stores the command (and the integral) in settings.STATE and returns it.
+    """
+    if dt is None:
+        dt = settings.YAW_GAIN_DT
+    snapshot = settings.STATE.snapshot("yaw_err", "yaw_err_capture_ns", "encoder_count", "yaw_int")
+    yaw_err, capture_ns, encoder_count, yaw_int = snapshot
+    # If invalid or stale value, no control
+    if yaw_err == settings.INVALID_VALUE or not snapshot.fresh("yaw_err", settings.YAW_ERR_MAX_AGE):
+        settings.STATE.yaw_control = settings.MOTOR_NEUTRAL
+        # A target seen again may be a different one, don't carry over its motion
+        if settings.TARGET_FILTER is not None:
+            settings.TARGET_FILTER.reset()
+            settings.TARGET_FILTER.add_encoder(time.perf_counter() - snapshot.age("encoder_count"), encoder_count)
+        return settings.MOTOR_NEUTRAL
+
+    # Derivative from consecutive vision samples, held until the next one arrives
+    if capture_ns != settings.PREV_YAW_ERR_NS:
+        sample_dt = (capture_ns - settings.PREV_YAW_ERR_NS) * 1e-9
+        if settings.PREV_YAW_ERR_NS and sample_dt > 0:
+            settings.YAW_DERIV = (yaw_err - settings.PREV_YAW_ERR) * settings.YAW_GAIN_DT / sample_dt
+        settings.PREV_YAW_ERR = yaw_err
+        settings.PREV_YAW_ERR_NS = capture_ns
+
+    # Compensate the vision latency and keep the error current between vision samples
+    if settings.TARGET_FILTER is not None:
+        # Encoder samples are timed by when the ESP32 thread read them, not by this tick
+        now = time.perf_counter()
+        predicted = settings.TARGET_FILTER.track(now, encoder_count, now - snapshot.age("encoder_count"),
+                                                 capture_ns, yaw_err)
+        if predicted is not None:
+            yaw_err = predicted
+
     # If we are outside allowed limits, only control in the right direction
     # Checking abs. value and that error and encoder count and
     # that it wants to control in the opposite direction
-    if abs(settings.ENCODER_COUNT) >= settings.YAW_LIMIT and settings.ENCODER_COUNT * settings.YAW_ERR < 0:
-        settings.YAW_CONTROL = settings.MOTOR_NEUTRAL
+    if abs(encoder_count) >= settings.YAW_LIMIT and encoder_count * yaw_err < 0:
+        settings.STATE.yaw_control = settings.MOTOR_NEUTRAL
         print("Outside yaw limits")
-        return
+        return settings.MOTOR_NEUTRAL
 
-    if abs(settings.K_I_YAW * (settings.YAW_INT + settings.YAW_ERR)) < 100:
-        settings.YAW_INT += settings.YAW_ERR
+    step = yaw_err * dt / settings.YAW_GAIN_DT
+    if abs(settings.K_I_YAW * (yaw_int + step)) < 100:
+        yaw_int += step
     
     # In case error changes sign, remove all integral windup
-    if settings.YAW_INT * settings.YAW_ERR < 0:
-        settings.YAW_INT = 0
-    output = settings.K_P_YAW * settings.YAW_ERR \
-        + settings.K_I_YAW * settings.YAW_INT \
-        + settings.K_D_YAW * (settings.YAW_ERR - settings.PREV_YAW_ERR)
-    settings.PREV_YAW_ERR = settings.YAW_ERR
+    if yaw_int * yaw_err < 0:
+        yaw_int = 0
+
+    output = settings.K_P_YAW * yaw_err \
+        + settings.K_I_YAW * yaw_int \
+        + settings.K_D_YAW * settings.YAW_DERIV
 
     # Control in positive direction
     if output > 0:
         output = min(output, 100)
-        settings.YAW_CONTROL = positive_yaw_pwm_map(output)
+        command = positive_yaw_pwm_map(output)
         #print(f"Commanded: {output}%")
     else: # Control in negative direction
         output = min(-output, 100.)
-        settings.YAW_CONTROL = negative_yaw_pwm_map(output)
+        command = negative_yaw_pwm_map(output)
         #print(f"Commanded: -{output}%")
+    settings.STATE.update(yaw_int=yaw_int, yaw_control=command)
+    return command
+
+
+def fire_command(dist: float) -> int:
+    """Look up the firing command for a target distance in the launch table"""
+    if settings.LAUNCH_TABLE is None:
+        return settings.FIRE_COMMAND_DEFAULT
+    return settings.LAUNCH_TABLE.lookup(dist)
 
 
 def firing_seq():
@@ -179,8 +267,8 @@ def firing_seq():
     the motor and command the servo to fire the frisbee
     """
 
-    # Calculate average distance
-    dist = np.mean(settings.RANGE_VALS)
+    # Calculate average distance, ignoring outliers
+    dist = settings.RANGE_VALS.robust_mean(settings.RANGE_OUTLIER_TOL)
     
     # Command motor to fire proportionally to the distance
 
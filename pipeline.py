@@ -0,0 +1,38 @@
+import queue
+
+
+class LatestQueue():
+    """
+    Bounded queue between two pipeline stages. When the consumer falls behind
+    the oldest item is dropped, so the consumer always works on the newest data
+    """
+    def __init__(self, name: str, maxsize: int = 1):
+        self.name = name
+        # Number of stale items dropped so far
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize)
+
+    def put(self, item):
+        while True:
+            try:
+                self._queue.put_nowait(item)
+                return
+            except queue.Full:
+                # Make room by throwing away the oldest item
+                try:
+                    self._queue.get_nowait()
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
+
+    def get(self, timeout: float = None):
+        """Get the oldest item, raises queue.Empty on timeout"""
+        return self._queue.get(timeout=timeout)
+
+    def depth(self) -> int:
+        return self._queue.qsize()
+
+
+def format_depths(queues) -> str:
+    """One line summary of the queue depths and dropped items"""
+    return ", ".join(f"{q.name}: {q.depth()} ({q.dropped} dropped)" for q in queues)
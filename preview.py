@@ -0,0 +1,119 @@
+import os
+import time
+import queue
+import threading
+import cv2
+import numpy as np
+from ultralytics.utils.plotting import Annotator
+
+import settings
+import pipeline
+import protocol
+
+
+class PreviewSink():
+    """
+    Draws detections on their frames on its own thread at a capped rate, and
+    optionally writes them to one video per client. Keeps the drawing and
+    encoding cost off the inference thread. The window is shown by poll(),
+    which must run on the main thread as HighGUI is not thread safe.
+    """
+    def __init__(self, stop: threading.Event, show: bool = True, record: str = None,
+                 rate: float = 5.):
+        self.stop = stop
+        self.show = show
+        self.record = record
+        self.rate = rate
+        # Newest detections of every client, filled by the inference thread
+        self.detections = pipeline.LatestQueue("preview", settings.MAX_CLIENTS)
+        self.writers = {}
+        # Newest drawn frame of every client, waiting for poll() to show it
+        self.frames = {}
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.run, name="preview", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def put(self, address, image, transform, boxes, track_ids):
+        self.detections.put((address, image, transform, boxes, track_ids))
+
+    def run(self):
+        try:
+            while not self.stop.is_set():
+                tick = time.perf_counter()
+                # Only draw the newest frame of every client this tick
+                newest = {}
+                while True:
+                    try:
+                        item = self.detections.get(timeout=0)
+                    except queue.Empty:
+                        break
+                    newest[item[0]] = item
+                for address, image, transform, boxes, track_ids in newest.values():
+                    image = draw(to_full_frame(image, transform), boxes, track_ids, transform)
+                    if self.show:
+                        with self.lock:
+                            self.frames[address] = image
+                    if self.record is not None:
+                        self.write(address, image)
+                time.sleep(max(tick + 1. / self.rate - time.perf_counter(), 0.))
+        except Exception as e:
+            print(f"Exception thrown in preview thread: {e}")
+        finally:
+            for writer, _ in self.writers.values():
+                writer.release()
+
+    def poll(self):
+        """Show the newest drawn frames and handle the window keys, on the main thread"""
+        with self.lock:
+            frames, self.frames = self.frames, {}
+        for address, image in frames.items():
+            cv2.imshow(f'Person tracker {address[0]}', image)
+        # Quit capturing when 'q' is pressed
+        if cv2.waitKey(1) & 0xFF == ord('q'):
+            print("Preview closed, shutting down...")
+            self.stop.set()
+
+    def close(self):
+        """Close the windows, on the main thread"""
+        if self.show:
+            cv2.destroyAllWindows()
+
+    def write(self, address, image):
+        if address not in self.writers:
+            root, ext = os.path.splitext(self.record)
+            path = f"{root}_{len(self.writers)}{ext or '.mp4'}"
+            print(f"Recording {address} to {path}")
+            size = (image.shape[1], image.shape[0])
+            self.writers[address] = (cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'mp4v'), self.rate, size), size)
+        writer, size = self.writers[address]
+        # Every frame of a video must have the same size
+        if (image.shape[1], image.shape[0]) != size:
+            image = cv2.resize(image, size)
+        writer.write(image)
+
+
+def to_full_frame(image, transform):
+    """Place a cropped, scaled image where it belongs in a black full size frame"""
+    offset_x, offset_y, scale = transform
+    if scale != 1.:
+        image = cv2.resize(image, None, fx=1. / scale, fy=1. / scale)
+    if offset_x == 0 and offset_y == 0 and image.shape[1] == settings.IMG_WIDTH:
+        return image
+    frame = np.zeros((offset_y + image.shape[0], settings.IMG_WIDTH, 3), dtype=np.uint8)
+    width = min(image.shape[1], settings.IMG_WIDTH - offset_x)
+    frame[offset_y:, offset_x:offset_x + width] = image[:, :width]
+    return frame
+
+
+def draw(image, boxes, track_ids, transform):
+    """Draw bounding boxes, labels and centerpoints, boxes are in sent image pixels"""
+    annotator = Annotator(image, line_width=2, example="test")
+    for box, track_id in zip(boxes, track_ids):
+        box = protocol.to_full_frame(box, transform)
+        annotator.box_label(box, label=f'Person {track_id}', color=(0, 255, 0))
+        center_x = int((box[0] + box[2]) / 2)
+        center_y = int((box[1] + box[3]) / 2)
+        cv2.circle(image, center=(center_x, center_y), radius=5, color=(0,0,255), thickness=-1)
+    return annotator.result()
@@ -0,0 +1,194 @@
+"""
+Binary message format shared by client.py and server.py.
+
+Every message starts with a header (version, message type, body length),
+followed by the body:
+    FRAME: frame sequence number, capture timestamp [ns], crop offset x, y [px],
+           scale, JPEG data. A pixel (u, v) in the JPEG is at
+           (x + u / scale, y + v / scale) in the full camera frame.
+    REPLY: frame sequence number, capture timestamp [ns] (echoed),
+           inference timestamp [ns], box x0, y0, x1, y1 [px]
+    SHM_OPEN: number of slots, slot size [bytes], name of a shared memory
+           frame ring (shm_transport.FrameRing) used by the following RAW_FRAMEs
+    RAW_FRAME: like FRAME, but instead of JPEG data the ring slot and the
+           height and width of a BGR frame written there, for a client and
+           server on the same machine
+Timestamps are from the sender's monotonic clock, so the capture timestamp
+only means something to the client and the inference timestamp to the server.
+"""
+import struct
+import asyncio
+
+VERSION = 3
+
+# Message types
+FRAME = 1
+REPLY = 2
+SHM_OPEN = 3
+RAW_FRAME = 4
+
+# Version, message type, body length
+HEADER = struct.Struct('<BBL')
+# Longest body [bytes] accepted, the length comes from the peer and sizes the receive buffer
+MAX_MESSAGE_SIZE = 16 << 20
+# Sequence number, capture timestamp, crop offset, scale
+FRAME_FIELDS = struct.Struct('<IqHHf')
+# Sequence number, capture timestamp, inference timestamp, box corners
+REPLY_FIELDS = struct.Struct('<Iqq4i')
+# Number of slots, slot size
+SHM_OPEN_FIELDS = struct.Struct('<IQ')
+# Sequence number, capture timestamp, crop offset, scale, slot, height, width
+RAW_FRAME_FIELDS = struct.Struct('<IqHHfIHH')
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def send_frame(sock, seq: int, capture_ns: int, jpeg, transform=(0, 0, 1.)):
+    """
+    Send a JPEG frame, the image data is passed on without copying. The
+    transform is the crop offset and scale of the image in the full frame.
+    """
+    sock.sendall(HEADER.pack(VERSION, FRAME, FRAME_FIELDS.size + len(jpeg))
+                 + FRAME_FIELDS.pack(seq, capture_ns, *transform))
+    sock.sendall(jpeg)
+
+
+def parse_frame(body):
+    """Returns the sequence number, capture timestamp, transform and JPEG data of a frame body"""
+    seq, capture_ns, offset_x, offset_y, scale = FRAME_FIELDS.unpack_from(body)
+    return seq, capture_ns, (offset_x, offset_y, scale), memoryview(body)[FRAME_FIELDS.size:]
+
+
+def send_shm_open(sock, name: str, slots: int, slot_size: int):
+    name = name.encode()
+    sock.sendall(HEADER.pack(VERSION, SHM_OPEN, SHM_OPEN_FIELDS.size + len(name))
+                 + SHM_OPEN_FIELDS.pack(slots, slot_size) + name)
+
+
+def parse_shm_open(body):
+    """Returns the name, number of slots and slot size of a frame ring"""
+    slots, slot_size = SHM_OPEN_FIELDS.unpack_from(body)
+    return bytes(body[SHM_OPEN_FIELDS.size:]).decode(), slots, slot_size
+
+
+def send_raw_frame(sock, seq: int, capture_ns: int, slot: int, shape, transform=(0, 0, 1.)):
+    sock.sendall(HEADER.pack(VERSION, RAW_FRAME, RAW_FRAME_FIELDS.size)
+                 + RAW_FRAME_FIELDS.pack(seq, capture_ns, *transform, slot, shape[0], shape[1]))
+
+
+def parse_raw_frame(body):
+    """Returns the sequence number, capture timestamp, transform and (slot, frame shape) of a raw frame"""
+    seq, capture_ns, offset_x, offset_y, scale, slot, height, width = RAW_FRAME_FIELDS.unpack(body)
+    return seq, capture_ns, (offset_x, offset_y, scale), (slot, (height, width, 3))
+
+
+def to_full_frame(box, transform):
+    """Map a box [x0, y0, x1, y1] in a sent image back to full frame pixels"""
+    offset_x, offset_y, scale = transform
+    return [int(offset_x + box[0] / scale), int(offset_y + box[1] / scale),
+            int(offset_x + box[2] / scale), int(offset_y + box[3] / scale)]
+
+
+def pack_reply(seq: int, capture_ns: int, infer_ns: int, box) -> bytes:
+    return HEADER.pack(VERSION, REPLY, REPLY_FIELDS.size) \
+        + REPLY_FIELDS.pack(seq, capture_ns, infer_ns, *box)
+
+
+def parse_reply(body):
+    """Returns the sequence number, capture and inference timestamps and the box"""
+    seq, capture_ns, infer_ns, x0, y0, x1, y1 = REPLY_FIELDS.unpack(body)
+    return seq, capture_ns, infer_ns, (x0, y0, x1, y1)
+
+
+def parse_header(header):
+    """Returns the message type and body length of a message header"""
+    version, msg_type, length = HEADER.unpack(header)
+    if version != VERSION:
+        raise ProtocolError(f"Unsupported protocol version {version}")
+    if length > MAX_MESSAGE_SIZE:
+        raise ProtocolError(f"Message of {length} bytes exceeds {MAX_MESSAGE_SIZE} bytes")
+    return msg_type, length
+
+
+def read_message(stream):
+    """Read one message from a file-like stream, returns the message type and body"""
+    header = stream.read(HEADER.size)
+    if len(header) < HEADER.size:
+        raise ConnectionError("Connection closed")
+    msg_type, length = parse_header(header)
+    body = stream.read(length)
+    if len(body) < length:
+        raise ConnectionError("Connection closed")
+    return msg_type, body
+
+
+class BufferPool():
+    """Reusable receive buffers, grown by replacing them with larger ones"""
+    def __init__(self):
+        self.free = []
+
+    def get(self, size: int) -> bytearray:
+        for i, buffer in enumerate(self.free):
+            if len(buffer) >= size:
+                return self.free.pop(i)
+        if self.free:
+            # All too small, replace one with a larger buffer
+            self.free.pop()
+        # Some headroom, frame sizes vary with the image content
+        return bytearray(min(size + size // 4, MAX_MESSAGE_SIZE))
+
+    def put(self, buffer: bytearray):
+        self.free.append(buffer)
+
+
+class MessageProtocol(asyncio.BufferedProtocol):
+    """
+    Receives messages with recv_into straight into pooled buffers, so message
+    bodies are never copied after leaving the socket. Subclasses handle them in
+    on_message(msg_type, body, buffer), where body is a memoryview into buffer,
+    and hand the buffer back with release(buffer) once done with the body.
+    """
+    def __init__(self):
+        self.pool = BufferPool()
+        self.header = bytearray(HEADER.size)
+        self._expect_header()
+
+    def _expect_header(self):
+        self.target = memoryview(self.header)
+        self.pos = 0
+        self.buffer = None
+        self.msg_type = None
+
+    def get_buffer(self, sizehint: int):
+        return self.target[self.pos:]
+
+    def buffer_updated(self, nbytes: int):
+        self.pos += nbytes
+        if self.pos < len(self.target):
+            return
+        if self.buffer is None:
+            try:
+                self.msg_type, length = parse_header(self.header)
+            except ProtocolError as e:
+                print(f"Closing connection: {e}")
+                self.transport.close()
+                return
+            self.buffer = self.pool.get(length)
+            self.target = memoryview(self.buffer)[:length]
+            self.pos = 0
+            if length:
+                return
+        msg_type, body, buffer = self.msg_type, self.target, self.buffer
+        self._expect_header()
+        self.on_message(msg_type, body, buffer)
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def on_message(self, msg_type: int, body: memoryview, buffer: bytearray):
+        raise NotImplementedError
+
+    def release(self, buffer: bytearray):
+        self.pool.put(buffer)
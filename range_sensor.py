@@ -0,0 +1,97 @@
+import numpy as np
+
+# Length of one range frame, e.g. b"D: 012.345m": three header bytes,
+# three integer digits, a decimal point, three decimal digits and a terminator
+FRAME_LEN = 11
+# Offset of the decimal point within a frame
+POINT = 6
+_DIGITS = frozenset(b"0123456789")
+
+
+class RangeParser():
+    """
+    Splits the range sensor byte stream into frames. Frames are found by their
+    structure (digits around the decimal point) rather than by counting bytes,
+    so the parser resynchronizes after dropped or corrupted bytes.
+    """
+    def __init__(self):
+        # Received bytes not yet parsed, reused between reads
+        self.buffer = bytearray()
+        # Bytes skipped while resynchronizing
+        self.skipped = 0
+
+    def feed(self, data: bytes):
+        """Add received bytes, returns the distances [m] of all complete valid frames"""
+        self.buffer += data
+        distances = []
+        start = 0
+        while True:
+            # Look for the next decimal point that can be part of a frame
+            point = self.buffer.find(b".", start + POINT)
+            if point < 0:
+                # A later frame can only start within the last few bytes
+                start = max(start, len(self.buffer) - POINT)
+                break
+            frame_start = point - POINT
+            if frame_start + FRAME_LEN > len(self.buffer):
+                # Incomplete frame, wait for the rest
+                start = frame_start
+                break
+            frame = self.buffer[frame_start:frame_start + FRAME_LEN]
+            if _is_valid(frame):
+                distances.append(_decode(frame))
+                start = frame_start + FRAME_LEN
+            else:
+                # Not a frame, search again after this decimal point
+                start = frame_start + 1
+        # Everything consumed that was not part of a frame was skipped
+        self.skipped += start - FRAME_LEN * len(distances)
+        del self.buffer[:start]
+        return distances
+
+
+def _is_valid(frame) -> bool:
+    return all(frame[i] in _DIGITS for i in (3, 4, 5, 7, 8, 9))
+
+
+def _decode(frame) -> float:
+    return (frame[3] - 0x30) * 100 + (frame[4] - 0x30) * 10 + (frame[5] - 0x30) * 1 + \
+        (frame[7] - 0x30) * 0.1 + (frame[8] - 0x30) * 0.01 + (frame[9] - 0x30) * 0.001
+
+
+class RangeRing():
+    """Fixed-size ring buffer of range measurements with outlier rejection"""
+    def __init__(self, size: int):
+        self.values = np.zeros(size)
+        # Index of the next write and number of valid samples
+        self.head = 0
+        self.count = 0
+
+    def append(self, value: float):
+        self.values[self.head] = value
+        self.head = (self.head + 1) % len(self.values)
+        self.count = min(self.count + 1, len(self.values))
+
+    def clear(self):
+        self.count = 0
+
+    def __len__(self) -> int:
+        return self.count
+
+    def latest(self, n: int = None):
+        """The n (default all) most recent samples, oldest first"""
+        n = self.count if n is None else min(n, self.count)
+        return np.take(self.values, np.arange(self.head - n, self.head), mode="wrap")
+
+    def median(self) -> float:
+        return float(np.median(self.latest()))
+
+    def robust_mean(self, tolerance: float) -> float:
+        """Mean of the samples within tolerance [m] of the median"""
+        samples = self.latest()
+        inliers = samples[np.abs(samples - np.median(samples)) <= tolerance]
+        return float(np.mean(inliers))
+
+    def num_inliers(self, tolerance: float) -> int:
+        samples = self.latest()
+        return int(np.count_nonzero(np.abs(samples - np.median(samples)) <= tolerance))
@@ -0,0 +1,282 @@
+import time
+import struct
+import threading
+import cv2
+import numpy as np
+from serial import Serial
+
+import settings
+
+# Log record header: time since the start of the recording [s], source, payload length
+RECORD = struct.Struct('<dBI')
+
+# Record sources
+CAMERA = 0
+RANGE_RX = 1
+RANGE_TX = 2
+ESP32_RX = 3
+ESP32_TX = 4
+# Received and sent sources of every serial device
+SERIAL_SOURCES = {"range": (RANGE_RX, RANGE_TX), "esp32": (ESP32_RX, ESP32_TX)}
+
+_recorder = None
+_replay_log = None
+_open_lock = threading.Lock()
+
+
+class Recorder():
+    """Appends timestamped camera frames and serial traffic to a log file"""
+    def __init__(self, path: str):
+        self.file = open(path, "wb")
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+
+    def write(self, source: int, payload: bytes):
+        if not payload:
+            return
+        with self.lock:
+            if self.file.closed:
+                return
+            self.file.write(RECORD.pack(time.perf_counter() - self.start, source, len(payload)))
+            self.file.write(payload)
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+class RecordingSerial():
+    """Serial port wrapper logging everything read and written"""
+    def __init__(self, serial, recorder: Recorder, name: str):
+        self.serial = serial
+        self.recorder = recorder
+        self.rx, self.tx = SERIAL_SOURCES[name]
+
+    def read(self, size: int = 1) -> bytes:
+        data = self.serial.read(size)
+        self.recorder.write(self.rx, data)
+        return data
+
+    def readline(self) -> bytes:
+        data = self.serial.readline()
+        self.recorder.write(self.rx, data)
+        return data
+
+    def write(self, data: bytes):
+        self.recorder.write(self.tx, data)
+        return self.serial.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.serial, name)
+
+    def __setattr__(self, name, value):
+        # Settings such as the timeout go to the real port
+        if name in ("serial", "recorder", "rx", "tx"):
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self.serial, name, value)
+
+
+class RecordingCapture():
+    """Video capture wrapper logging every frame as a JPEG"""
+    def __init__(self, cap, recorder: Recorder):
+        self.cap = cap
+        self.recorder = recorder
+
+    def read(self):
+        ret, frame = self.cap.read()
+        if ret:
+            _, buffer = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, 95])
+            self.recorder.write(CAMERA, buffer.tobytes())
+        return ret, frame
+
+    def __getattr__(self, name):
+        return getattr(self.cap, name)
+
+
+class ReplayLog():
+    """A loaded log, replayed in real time (scaled by settings.REPLAY_SPEED) from when it was loaded"""
+    def __init__(self, path: str):
+        self.records = {source: [] for source in (CAMERA, RANGE_RX, RANGE_TX, ESP32_RX, ESP32_TX)}
+        with open(path, "rb") as f:
+            data = f.read()
+        pos = 0
+        while pos + RECORD.size <= len(data):
+            t, source, length = RECORD.unpack_from(data, pos)
+            pos += RECORD.size
+            self.records[source].append((t, data[pos:pos + length]))
+            pos += length
+        self.duration = max((items[-1][0] for items in self.records.values() if items), default=0.)
+        self.start = time.perf_counter()
+
+    def elapsed(self) -> float:
+        """Current position in the log [s]"""
+        return (time.perf_counter() - self.start) * settings.REPLAY_SPEED
+
+
+class Playback():
+    """Iterates over the records of one source, looping if settings.REPLAY_LOOP is set"""
+    def __init__(self, log: ReplayLog, source: int):
+        self.log = log
+        self.items = log.records[source]
+        self.i = 0
+        self.cycle = 0
+
+    def next_time(self) -> float:
+        """Log time of the next record, None when the log is finished"""
+        if self.i >= len(self.items):
+            if not settings.REPLAY_LOOP or not self.items or self.log.duration <= 0.:
+                return None
+            self.i = 0
+            self.cycle += 1
+        return self.items[self.i][0] + self.cycle * self.log.duration
+
+    def pop(self) -> bytes:
+        self.i += 1
+        return self.items[self.i - 1][1]
+
+    def wait(self, t: float, deadline: float = None) -> bool:
+        """Sleep until log time t, or until the deadline [perf_counter], returns whether t was reached"""
+        delay = (t - self.log.elapsed()) / settings.REPLAY_SPEED
+        if deadline is not None and time.perf_counter() + delay > deadline:
+            time.sleep(max(deadline - time.perf_counter(), 0.))
+            return False
+        if delay > 0.:
+            time.sleep(delay)
+        return True
+
+
+class ReplaySerial():
+    """Stand-in for a serial port serving the recorded received bytes at their recorded times"""
+    def __init__(self, log: ReplayLog, name: str, timeout: float = None):
+        self.playback = Playback(log, SERIAL_SOURCES[name][0])
+        self.timeout = timeout
+        self.buffer = bytearray()
+        self.is_open = True
+        # Number of writes and bytes written, e.g. for benchmarks
+        self.writes = 0
+        self.bytes_written = 0
+
+    def _fill(self, size: int):
+        """Wait for at least size bytes or the timeout"""
+        deadline = None if self.timeout is None else time.perf_counter() + self.timeout
+        while len(self.buffer) < size:
+            t = self.playback.next_time()
+            if t is None:
+                # Log finished, behave like a silent port
+                if deadline is not None:
+                    time.sleep(max(deadline - time.perf_counter(), 0.))
+                return
+            if not self.playback.wait(t, deadline):
+                return
+            self.buffer += self.playback.pop()
+
+    @property
+    def in_waiting(self) -> int:
+        # Everything recorded up to now counts as received
+        while True:
+            t = self.playback.next_time()
+            if t is None or t > self.playback.log.elapsed():
+                return len(self.buffer)
+            self.buffer += self.playback.pop()
+
+    def read(self, size: int = 1) -> bytes:
+        self._fill(size)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def readline(self) -> bytes:
+        deadline = None if self.timeout is None else time.perf_counter() + self.timeout
+        while b"\n" not in self.buffer:
+            t = self.playback.next_time()
+            if t is None:
+                # Log finished, behave like a silent port
+                if deadline is not None:
+                    time.sleep(max(deadline - time.perf_counter(), 0.))
+                break
+            if not self.playback.wait(t, deadline):
+                break
+            self.buffer += self.playback.pop()
+        end = self.buffer.find(b"\n") + 1 or len(self.buffer)
+        data = bytes(self.buffer[:end])
+        del self.buffer[:end]
+        return data
+
+    def write(self, data: bytes) -> int:
+        self.writes += 1
+        self.bytes_written += len(data)
+        return len(data)
+
+    def close(self):
+        self.is_open = False
+
+
+class ReplayCapture():
+    """Stand-in for a video capture serving the recorded frames at their recorded times"""
+    def __init__(self, log: ReplayLog):
+        self.playback = Playback(log, CAMERA)
+
+    def read(self):
+        t = self.playback.next_time()
+        if t is None:
+            return False, None
+        self.playback.wait(t)
+        data = self.playback.pop()
+        # Like a live camera, skip frames that are already stale
+        while True:
+            t = self.playback.next_time()
+            if t is None or t > self.playback.log.elapsed():
+                break
+            data = self.playback.pop()
+        return True, cv2.imdecode(np.frombuffer(data, dtype=np.uint8), 1)
+
+    def set(self, prop, value) -> bool:
+        return True
+
+    def release(self):
+        pass
+
+
+def _log():
+    """The replay log for settings.REPLAY_FILE, shared by all stand-ins so they stay in sync"""
+    global _replay_log
+    with _open_lock:
+        if _replay_log is None:
+            _replay_log = ReplayLog(settings.REPLAY_FILE)
+    return _replay_log
+
+
+def recorder():
+    """The recorder for settings.RECORD_FILE, None unless recording"""
+    global _recorder
+    with _open_lock:
+        if settings.RECORD_FILE is not None and _recorder is None:
+            _recorder = Recorder(settings.RECORD_FILE)
+    return _recorder
+
+
+def close():
+    """Flush and close the recording, if any"""
+    if _recorder is not None:
+        _recorder.close()
+
+
+def open_serial(name: str, port: str, **kwargs):
+    """Open a serial port, or its recording/replay stand-in depending on settings"""
+    if settings.REPLAY_FILE is not None:
+        return ReplaySerial(_log(), name, kwargs.get("timeout"))
+    serial = Serial(port, **kwargs)
+    if recorder() is not None:
+        return RecordingSerial(serial, recorder(), name)
+    return serial
+
+
+def open_camera():
+    """Open the camera, or its recording/replay stand-in depending on settings"""
+    if settings.REPLAY_FILE is not None:
+        return ReplayCapture(_log())
+    cap = cv2.VideoCapture(0, apiPreference=cv2.CAP_V4L)
+    if recorder() is not None:
+        return RecordingCapture(cap, recorder())
+    return cap
@@ -1,104 +1,434 @@
 import socket
-import struct
 import time
+import ipaddress
 import cv2
-import io
-import os
-import sys
+import argparse
+import asyncio
+import threading
 import numpy as np
-from ultralytics import YOLO
-from ultralytics.utils.plotting import Annotator
+from concurrent.futures import ThreadPoolExecutor
+from ultralytics.engine.results import Boxes
+from ultralytics.trackers.byte_tracker import BYTETracker
+from ultralytics.utils import IterableSimpleNamespace, yaml_load
+from ultralytics.utils.checks import check_yaml
 
 import settings
+import pipeline
+import protocol
+import timing
+import detector
+import flow_tracker
+from shm_transport import FrameRing
+from preview import PreviewSink
 
 # Initialize global variables for scripts that are intended to run
 settings.init()
 
-def start_server(host: str, port: int):
-    # Create server socket, bind and start listening
-    server_socket = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
-    server_socket.bind((host, port))
-    server_socket.listen(0)
-    print(f"Server listening on IPV6 {host} port {port}")
-    # Load YOLOv8 nano model
-    model = YOLO('yolov8s.pt')
-    # Outer loop looking for connections, catches keyboard interrupts
-    try:
-        while True:
-            client_socket, client_address = server_socket.accept()
-            connection = client_socket.makefile('rb')
-            print(f"Accepted connection from {client_address}")
-            # Inner loop sending and receiving messages, catches exceptions during send/receive
+# Tracker configuration, each client gets its own tracker instance
+TRACKER_CFG = IterableSimpleNamespace(**yaml_load(check_yaml('bytetrack.yaml')))
+
+
+class Client(protocol.MessageProtocol):
+    """Connection state of one launcher, frames are received straight into reusable buffers"""
+    def __init__(self, server):
+        super().__init__()
+        self.server = server
+        self.address = None
+        # Newest frame not yet decoded and its receive buffer, older ones are dropped
+        self.latest = None
+        self.latest_buffer = None
+        self.received_ns = 0
+        # Decoded frame waiting for inference: (frame, image, transform, received_ns)
+        self.decoded = None
+        self.dropped = 0
+        # Shared memory frame ring of a client on the same machine
+        self.ring = None
+        self.tracker = BYTETracker(args=TRACKER_CFG, frame_rate=settings.CAM_FPS)
+        # Follows the target between detections, see settings.DETECT_PERIOD
+        self.flow = flow_tracker.FlowTracker()
+        self.track_id = None
+        self.frames_since_detect = 0
+        # Grayscale of the frame being processed, for the flow tracker
+        self.gray = None
+        self.detections = 0
+        self.followed = 0
+        # Counts at the last statistics report
+        self.reported = (0, 0, 0)
+
+    def connection_made(self, transport):
+        super().connection_made(transport)
+        self.address = transport.get_extra_info('peername')
+        if len(self.server.clients) >= settings.MAX_CLIENTS:
+            print(f"Refusing connection from {self.address}, already serving {len(self.server.clients)} clients")
+            transport.close()
+            return
+        self.server.clients.add(self)
+        print(f"Accepted connection from {self.address}")
+
+    def connection_lost(self, exc):
+        if self not in self.server.clients:
+            return
+        print(f"Closing connection from {self.address}" + (f": {exc}" if exc else ""))
+        self.server.clients.discard(self)
+        self.latest = None
+        self.decoded = None
+        if self.ring is not None:
+            self.ring.close()
+
+    def on_message(self, msg_type, body, buffer):
+        try:
+            if msg_type == protocol.FRAME:
+                frame = protocol.parse_frame(body)
+            elif msg_type == protocol.RAW_FRAME:
+                if self.ring is None:
+                    raise protocol.ProtocolError("Raw frame before a shared memory ring was opened")
+                seq, capture_ns, transform, (slot, shape) = protocol.parse_raw_frame(body)
+                # Copy the frame out right away, the client reuses the slot once it
+                # gives up waiting for the reply
+                frame = (seq, capture_ns, transform, self.ring.view(slot, shape).copy())
+                # The pixels are in the ring, the message buffer is free again
+                self.release(buffer)
+                buffer = None
+            elif msg_type == protocol.SHM_OPEN:
+                # Attaching reads any named shared memory of this machine, only for local clients
+                if not settings.SHARED_MEMORY_FRAMES or not is_loopback(self.address):
+                    raise protocol.ProtocolError("Shared memory frames are not accepted from this client")
+                if self.ring is not None:
+                    self.ring.close()
+                self.ring = FrameRing.attach(*protocol.parse_shm_open(body))
+                print(f"Receiving raw frames from {self.address} through shared memory {self.ring.name}")
+                self.release(buffer)
+                return
+            else:
+                print(f"Ignoring message of type {msg_type}")
+                self.release(buffer)
+                return
+        except Exception as e:
+            print(f"Error handling client {self.address}: {e}")
+            self.transport.close()
+            return
+        if self.latest is not None:
+            self.dropped += 1
+            if self.latest_buffer is not None:
+                self.release(self.latest_buffer)
+        self.latest, self.latest_buffer = frame, buffer
+        self.received_ns = timing.now()
+        self.server.new_frame.set()
+
+    def follow(self, image, transform):
+        """The target box [full frame px] from optical flow, None when the frame needs a detection"""
+        self.gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        if not self.flow.active or self.frames_since_detect + 1 >= settings.DETECT_PERIOD:
+            return None
+        box = self.flow.update(self.gray, transform)
+        if box is None:
+            return None
+        self.frames_since_detect += 1
+        self.followed += 1
+        return box
+
+    def counts_since_report(self):
+        """Frames dropped, detected and followed since the last call"""
+        counts = (self.dropped, self.detections, self.followed)
+        since = tuple(count - reported for count, reported in zip(counts, self.reported))
+        self.reported = counts
+        return since
+
+
+def is_loopback(address) -> bool:
+    """Whether a peer address is on this machine"""
+    ip = ipaddress.ip_address(address[0].split("%")[0])
+    # IPv4 clients of the dual stack socket appear as IPv4-mapped IPv6 addresses
+    return (getattr(ip, "ipv4_mapped", None) or ip).is_loopback
+
+
+# Decode flags by size reduction factor
+REDUCED_FLAGS = {1: cv2.IMREAD_COLOR, 2: cv2.IMREAD_REDUCED_COLOR_2,
+                 4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8}
+# JPEG start of frame markers, they hold the image size
+SOF_MARKERS = frozenset((0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF))
+
+
+def jpeg_shape(data: memoryview):
+    """Height and width from the JPEG headers without decoding, None if not found"""
+    pos = 2
+    while pos + 9 <= len(data):
+        if data[pos] != 0xFF:
+            return None
+        marker = data[pos + 1]
+        if marker in SOF_MARKERS:
+            return (data[pos + 5] << 8 | data[pos + 6], data[pos + 7] << 8 | data[pos + 8])
+        # Skip the segment
+        pos += 2 + (data[pos + 2] << 8 | data[pos + 3])
+    return None
+
+
+def reduction(data) -> int:
+    """Largest decode size reduction that keeps the image at least as large as the model input"""
+    shape = jpeg_shape(data)
+    if shape is None:
+        return 1
+    size = max(shape)
+    for factor in (8, 4, 2):
+        if size >= factor * settings.DETECTOR_IMGSZ:
+            return factor
+    return 1
+
+
+def decode(frame):
+    """Decode a frame straight from its receive buffer, returns the image and its transform"""
+    seq, capture_ns, transform, data = frame
+    if isinstance(data, np.ndarray):
+        # Raw frame, already copied out of the client's shared memory ring
+        return data, transform
+    factor = reduction(data) if settings.REDUCED_DECODE else 1
+    image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), REDUCED_FLAGS[factor])
+    # A reduced image is one more downscale of the sent one
+    offset_x, offset_y, scale = transform
+    return image, (offset_x, offset_y, scale / factor)
+
+
+class BatchServer():
+    """
+    Keeps many launcher connections open on an asyncio loop and runs one
+    batched inference call over the newest frame of every client per tick.
+    Receiving, decoding and inference are pipelined: frames are decoded as
+    they arrive while the previous batch is being inferred on.
+    """
+    def __init__(self, model: detector.Detector, preview: PreviewSink, stop: threading.Event):
+        self.model = model
+        self.preview = preview
+        self.stop = stop
+        self.clients = set()
+        # Statistics since the last report
+        self.num_batches = 0
+        self.num_frames = 0
+        # Decoding runs in parallel, inference on a single worker
+        self.decoder = ThreadPoolExecutor(settings.MAX_CLIENTS)
+        self.inference = ThreadPoolExecutor(1)
+
+    def infer_batch(self, batch):
+        """Infer on one decoded frame per client, returns the replies"""
+        clients, frames, images, transforms, _ = zip(*batch)
+        # Follow locked targets with optical flow, only the other frames go to the detector
+        flow_ns = timing.now()
+        flow_boxes = list(self.decoder.map(Client.follow, clients, images, transforms))
+        inference_ns = timing.now()
+        timing.span("flow", flow_ns, inference_ns)
+        detect = [i for i, box in enumerate(flow_boxes) if box is None]
+        results = dict(zip(detect, self.model.predict([images[i] for i in detect]))) if detect else {}
+        if detect:
+            timing.span("inference", inference_ns)
+        replies = []
+        for i, (client, (seq, capture_ns, _, _), image, transform, _) in enumerate(batch):
+            # Boxes are in full frame pixels, the client may send cropped, scaled images
+            # and the tracker has to see the same coordinates from frame to frame
+            boxes, track_ids = [], []
+            if i in results:
+                # Detections are [x0, y0, x1, y1, conf, class] in sent image pixels
+                data = np.array(results[i], dtype=np.float32)
+                data[:, :4] = flow_tracker.to_full_frame(data[:, :4].reshape(-1, 2), transform).reshape(-1, 4)
+                offset_x, offset_y, scale = transform
+                det = Boxes(data, (int(offset_y + image.shape[0] / scale), settings.IMG_WIDTH))
+                if len(det):
+                    tracks = client.tracker.update(det, image)
+                    if len(tracks):
+                        # Tracks are [x0, y0, x1, y1, id, score, class, index]
+                        boxes = tracks[:, :4].tolist()
+                        track_ids = tracks[:, 4].astype(int).tolist()
+                client.detections += 1
+                client.frames_since_detect = 0
+                # Lock on to a single person, there is no control otherwise
+                if len(track_ids) == 1:
+                    client.track_id = track_ids[0]
+                    client.flow.start(client.gray, transform, boxes[0])
+                else:
+                    client.flow.stop()
+            else:
+                boxes = [flow_boxes[i].ravel().tolist()]
+                track_ids = [client.track_id]
+            # No control unless exactly one person in frame
+            if len(track_ids) == 1:
+                box = [int(x) for x in boxes[0]]
+            else:
+                box = [settings.INVALID_VALUE] * 4
+            replies.append(protocol.pack_reply(seq, capture_ns, time.perf_counter_ns(), box))
+            if self.preview is not None:
+                # Back to sent image pixels to draw on the image
+                boxes = [flow_tracker.to_image(np.reshape(b, (2, 2)), transform).ravel().tolist() for b in boxes]
+                self.preview.put(client.address, image, transform, boxes, track_ids)
+        return replies
+
+    async def decode_loop(self):
+        """Decode stage, decodes the newest received frame of every client"""
+        loop = asyncio.get_running_loop()
+        while not self.stop.is_set():
             try:
-                while True:
-                    # Read the length of the image as a 32-bit unsigned int
-                    image_len: int = struct.unpack('<L', connection.read(struct.calcsize('<L')))[0]
-                    #print(f'Received image of size {image_len} bytes')
-                    # If the length is zero, quit the loop
-                    if not image_len:
-                        print('No image received, waiting...')
-                        time.sleep(5)
-                        continue
-                    # Construct a stream to hold the image data and read the image
-                    # data from the connection
-                    image_stream = io.BytesIO()
-                    image_stream.write(connection.read(image_len))
-                    # Rewind the stream and decode the image data
-                    image_stream.seek(0)
-                    data = np.frombuffer(image_stream.getvalue(), dtype=np.uint8)
-                    image = cv2.imdecode(data, 1)  # 1 means load color image
-                    # Do inference
-                    results = model.track(image, persist=False, classes=[0], verbose=False)
-                    # If we detect people, extract IDs, draw bounding boxes
-                    if results[0].boxes.id == None:
-                        client_socket.send(f"{settings.INVALID_VALUE},{settings.INVALID_VALUE}".encode("utf-8"))
-                    else:
-                        # Extract top left and bottom right corner
-                        boxes = results[0].boxes.xyxy.cpu()
-                        track_ids = results[0].boxes.id.int().cpu().tolist()
-                        annotator = Annotator(image, line_width=2, example="test")
-                        
-                        # Add bounding boxes, labels and centerpoints
-                        for box, track_id in zip(boxes, track_ids):
-                            annotator.box_label(box, label=f'Person {track_id}', color=(0, 255, 0))
-                            box = box.tolist()
-                            center_x = int((box[0] + box[2]) / 2)
-                            center_y = int((box[1] + box[3]) / 2)
-                            cv2.circle(image, center=(center_x, center_y), radius=5, color=(0,0,255), thickness=-1)
-
-                        # No control unless exactly one person in frame
-                        if len(track_ids) == 1:
-                            client_socket.send(f"{int(box[0])},{int(box[2])}".encode("utf-8"))
-                        else:
-                            client_socket.send(f"{settings.INVALID_VALUE},{settings.INVALID_VALUE}".encode("utf-8"))
-
-                    cv2.imshow('Person tracker', image)
-
-                    # Quit capturing when 'q' is pressed
-                    if cv2.waitKey(1) & 0xFF == ord('q'):
-                        raise KeyboardInterrupt
-                
+                await asyncio.wait_for(self.new_frame.wait(), timeout=.1)
+            except asyncio.TimeoutError:
+                continue
+            self.new_frame.clear()
+            frames = []
+            for client in list(self.clients):
+                if client.latest is not None:
+                    frames.append((client, client.latest, client.latest_buffer, client.received_ns))
+                    timing.span("server_queue", client.received_ns)
+                    client.latest = client.latest_buffer = None
+            if not frames:
+                continue
+            decode_ns = timing.now()
+            # A frame that fails to decode (e.g. an empty or corrupt JPEG) is dropped like one that decodes to None
+            decoded = await asyncio.gather(
+                *(loop.run_in_executor(self.decoder, decode, frame) for _, frame, _, _ in frames),
+                return_exceptions=True)
+            timing.span("decode", decode_ns)
+            for (client, frame, buffer, received_ns), result in zip(frames, decoded):
+                # Decoded, the receive buffer can take new frames
+                if buffer is not None:
+                    client.release(buffer)
+                if isinstance(result, Exception) or result[0] is None:
+                    print(f"Could not decode frame {frame[0]} from {client.address}")
+                    continue
+                image, transform = result
+                # A decoded frame still waiting for inference is stale now
+                if client.decoded is not None:
+                    client.dropped += 1
+                client.decoded = (frame, image, transform, received_ns)
+            self.new_image.set()
+
+    async def inference_loop(self):
+        """Inference stage, runs one batch over the newest decoded frame of every client"""
+        loop = asyncio.get_running_loop()
+        while not self.stop.is_set():
+            try:
+                await asyncio.wait_for(self.new_image.wait(), timeout=.1)
+            except asyncio.TimeoutError:
+                continue
+            self.new_image.clear()
+            batch = []
+            for client in list(self.clients):
+                if client.decoded is not None:
+                    batch.append((client, *client.decoded))
+                    client.decoded = None
+            if not batch:
+                continue
+            try:
+                replies = await loop.run_in_executor(self.inference, self.infer_batch, batch)
             except Exception as e:
-                print(f"Error handling client: {e}")
+                # Find the offending frames one by one so the other clients are still served
+                print(f"Exception thrown in batch inference: {e}")
+                replies = []
+                for item in batch:
+                    try:
+                        replies += await loop.run_in_executor(self.inference, self.infer_batch, [item])
+                    except Exception as e:
+                        print(f"Exception thrown in inference for {item[0].address}, closing connection: {e}")
+                        item[0].transport.close()
+                        replies.append(None)
+            self.num_batches += 1
+            self.num_frames += len(batch)
+            for (client, _, _, _, received_ns), reply in zip(batch, replies):
+                if reply is not None and client in self.clients:
+                    client.transport.write(reply)
+                    timing.span("server_total", received_ns)
+
+    async def serve(self, host: str, port: int):
+        self.new_frame = asyncio.Event()
+        self.new_image = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        server = await loop.create_server(lambda: Client(self), host, port,
+                                          family=socket.AF_INET6, backlog=settings.MAX_CLIENTS)
+        print(f"Server listening on IPV6 {host} port {port}")
+        async with server:
+            await asyncio.gather(self.decode_loop(), self.inference_loop())
+        for client in list(self.clients):
+            client.transport.close()
+
+    def report(self) -> str:
+        """One line summary of clients, batching, dropped frames and stage backlogs since the last report"""
+        mean_batch = self.num_frames / self.num_batches if self.num_batches else 0.
+        self.num_batches = 0
+        self.num_frames = 0
+        clients = list(self.clients)
+        counts = [client.counts_since_report() for client in clients]
+        dropped, detections, followed = (sum(c) for c in zip(*counts)) if counts else (0, 0, 0)
+        # Each client holds at most one frame per stage, so a stage's depth is the clients with a frame waiting
+        pending_decode = sum(client.latest is not None for client in clients)
+        pending_inference = sum(client.decoded is not None for client in clients)
+        report = f"{len(clients)} clients, mean batch size {mean_batch:.2f}, {dropped} frames dropped, " \
+            f"{detections} detected, {followed} followed by optical flow, " \
+            f"decode: {pending_decode} pending, inference: {pending_inference} pending"
+        if self.preview is not None:
+            report += f", {pipeline.format_depths([self.preview.detections])}"
+        return report
 
-            finally:
-                print(f"Closing connection from {client_address}")
-                client_socket.close()
-                cv2.destroyAllWindows()
+
+def start_server(host: str, port: int, headless: bool = False, record: str = None,
+                 preview_rate: float = 5.):
+    # Load the detection model and get it ready before accepting connections
+    model = detector.load_detector()
+    print(f"Warming up the {model.name} detector")
+    model.warm_up(settings.DETECTOR_WARMUP)
+    stop = threading.Event()
+    # Preview and recording run on their own thread, skipped entirely when headless
+    preview = None
+    if not headless or record is not None:
+        preview = PreviewSink(stop, show=not headless, record=record, rate=preview_rate)
+        preview.start()
+    batch_server = BatchServer(model, preview, stop)
+    # The network and inference side runs on an asyncio loop in the background
+    server_thread = threading.Thread(target=asyncio.run, args=(batch_server.serve(host, port),), daemon=True)
+    server_thread.start()
+    timing_thread = timing.start("server")
+    # Main thread shows the preview window and reports statistics, catches keyboard interrupts
+    try:
+        show = preview is not None and preview.show
+        stats_timer = time.perf_counter()
+        while server_thread.is_alive():
+            server_thread.join(timeout=1. / preview_rate if show else settings.STATS_PERIOD)
+            if show:
+                # HighGUI calls have to stay on the main thread
+                preview.poll()
+            if time.perf_counter() > stats_timer + settings.STATS_PERIOD:
+                print(batch_server.report())
+                stats_timer = time.perf_counter()
 
     # Keyboard interrupt is the exit condition, final cleanup is here
     except KeyboardInterrupt:
         print("Server shutting down...")
-        server_socket.close()
-        connection.close()
-        cv2.destroyAllWindows()
+
+    finally:
+        stop.set()
+        server_thread.join(timeout=1.)
+        if preview is not None:
+            preview.thread.join(timeout=1.)
+            preview.close()
+        # Let the timing thread write its final statistics
+        settings.SHOULD_EXIT.set()
+        if timing_thread is not None:
+            timing_thread.join(timeout=1.)
 
 
 if __name__ == "__main__":
-    if len(sys.argv) != 3:
-        print(f"Usage: python3 {os.path.basename(__file__)} <host> <port>")
-        sys.exit(1)
-    
-    host: str = sys.argv[1]
-    port: int = int(sys.argv[2])
-    start_server(host, port)
+    parser = argparse.ArgumentParser(description="Person detection server for the frisbee launchers")
+    parser.add_argument("host")
+    parser.add_argument("port", type=int)
+    parser.add_argument("--headless", action="store_true", help="run without a preview window")
+    parser.add_argument("--record", metavar="FILE", help="write annotated video, one file per client")
+    parser.add_argument("--preview-rate", type=float, default=5., help="preview/recording rate [Hz]")
+    parser.add_argument("--timing", action="store_true", help="write latency histograms to timing_server.csv")
+    parser.add_argument("--backend", choices=detector.BACKENDS, default=settings.DETECTOR_BACKEND,
+                        help="inference backend, onnx and openvino export and cache the model on first use")
+    parser.add_argument("--weights", default=settings.DETECTOR_WEIGHTS)
+    parser.add_argument("--imgsz", type=int, default=settings.DETECTOR_IMGSZ, help="model input size")
+    parser.add_argument("--threads", type=int, default=settings.DETECTOR_THREADS,
+                        help="inference threads (0: runtime default)")
+    parser.add_argument("--int8", action="store_true", help="use the INT8 quantized model")
+    args = parser.parse_args()
+    settings.TIMING = settings.TIMING or args.timing
+    settings.DETECTOR_BACKEND = args.backend
+    settings.DETECTOR_WEIGHTS = args.weights
+    settings.DETECTOR_IMGSZ = args.imgsz
+    settings.DETECTOR_THREADS = args.threads
+    settings.DETECTOR_INT8 = settings.DETECTOR_INT8 or args.int8
+    start_server(args.host, args.port, args.headless, args.record, args.preview_rate)
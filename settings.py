@@ -1,13 +1,27 @@
 import threading
 import time
 
+from state import SharedState
+
 def init():
-    global RANGE, SHOULD_EXIT, IMG_WIDTH, INVALID_VALUE, RANGE_FILE, \
-    YAW_ERR, CAM_FPS, K_P_YAW, YAW_PWM_PIN, PWM_FREQ, ESP32_FILE, \
-    MOTOR_NEUTRAL, YAW_CONTROL, ENCODER_COUNT, YAW_LIMIT, YAW_TIMEOUT, \
-    YAW_RESET_TIMER, YAW_IS_RESET, GET_RANGE_PROP, PERSON_BOUNDS, \
-    RANGE_VALS, SUFF_NUM_MEAS, FIRE_REQUEST, FIRE_COMMAND, FIRE_COOLDOWN, \
-    FIRE_TIMER, YAW_INT, K_I_YAW, K_D_YAW, PREV_YAW_ERR
+    global SHOULD_EXIT, IMG_WIDTH, INVALID_VALUE, RANGE_FILE, CAM_FPS, \
+    K_P_YAW, YAW_PWM_PIN, PWM_FREQ, ESP32_FILE, MOTOR_NEUTRAL, \
+    YAW_LIMIT, YAW_TIMEOUT, YAW_RESET_TIMER, YAW_IS_RESET, GET_RANGE_PROP, \
+    RANGE_VALS, SUFF_NUM_MEAS, FIRE_COOLDOWN, K_I_YAW, \
+    K_D_YAW, PREV_YAW_ERR, LAUNCH_ANGLE, MAX_LAUNCH_SPEED, FIRE_COMMAND_MIN, \
+    FIRE_COMMAND_MAX, FIRE_COMMAND_DEFAULT, LAUNCH_TABLE_FILE, LAUNCH_TABLE, \
+    STATS_PERIOD, MAX_CLIENTS, MAX_FRAMES_IN_FLIGHT, \
+    REPLY_TIMEOUT, ENCODER_LEVELS, TARGET_RTT, ENCODER_HOLD, \
+    ENCODER_SMOOTHING, ROI_CROP, ROI_MARGIN, ROI_MIN_WIDTH, FULL_FRAME_PERIOD, TIMING, \
+    TIMING_DIR, TIMING_PERIOD, RECORD_FILE, REPLAY_FILE, REPLAY_SPEED, \
+    REPLAY_LOOP, RANGE_RING_SIZE, RANGE_OUTLIER_TOL, YAW_CONTROL_RATE, \
+    YAW_GAIN_DT, YAW_KEEPALIVE, PREV_YAW_ERR_NS, YAW_DERIV, STATE, \
+    YAW_ERR_MAX_AGE, DETECTOR_BACKEND, DETECTOR_WEIGHTS, DETECTOR_IMGSZ, \
+    DETECTOR_THREADS, DETECTOR_INT8, DETECTOR_WARMUP, DETECTOR_CONF, DETECTOR_IOU, \
+    DETECT_PERIOD, FLOW_MAX_POINTS, FLOW_MIN_POINTS, FLOW_MIN_CONFIDENCE, FLOW_FB_ERROR, \
+    TARGET_PREDICTION, YAW_PX_PER_COUNT, TARGET_ACCEL_NOISE, TARGET_MEAS_NOISE, \
+    TARGET_VEL_VAR, TARGET_MAX_HORIZON, TARGET_FILTER, LOCAL_TRANSPORT, REDUCED_DECODE, \
+    SHARED_MEMORY_FRAMES
 
     """ ACTUAL SETTINGS """
     # Image width
@@ -26,6 +40,12 @@ def init():
     K_D_YAW = .1
     # Previous yaw error value
     PREV_YAW_ERR = 0
+    # Rate [Hz] of the yaw control loop
+    YAW_CONTROL_RATE = 100.
+    # Timestep [s] the I and D gains are tuned for
+    YAW_GAIN_DT = .01
+    # Unchanged yaw commands are resent at least this often [s]
+    YAW_KEEPALIVE = .5
     # PWM pin for the yaw motor
     YAW_PWM_PIN = 32
     # PWM frequency (DO NOT TOUCH!!)
@@ -34,41 +54,134 @@ def init():
     MOTOR_NEUTRAL = 153
     # Encoder count the yaw motor is limited to in each direction
     YAW_LIMIT = 1000
+    # Yaw errors older than this [s] are not used for control or firing
+    YAW_ERR_MAX_AGE = 1.
+    # Control on the yaw error predicted to the current time (target_filter.py) instead of the
+    # last received one. Only enable once YAW_PX_PER_COUNT is calibrated.
+    TARGET_PREDICTION = False
+    # Image pixels per yaw encoder count (needs calibration), negative as the
+    # yaw error grows when the encoder count increases
+    YAW_PX_PER_COUNT = -1.
+    # Target acceleration noise [counts^2/s^3] and vision measurement noise [counts^2] of the prediction
+    TARGET_ACCEL_NOISE = 1e4
+    TARGET_MEAS_NOISE = 25.
+    # Velocity variance [(counts/s)^2] of a newly seen target
+    TARGET_VEL_VAR = 1e5
+    # Longest time [s] the yaw error is predicted ahead of the last vision sample
+    TARGET_MAX_HORIZON = .5
     # How long [seconds] we accept invalid yaw errors until we reset the yaw
     YAW_TIMEOUT = 5.
     # Condition for considering the range sensor to be pointing at the person
     GET_RANGE_PROP = .45
     # Sufficiently many measurements in order to fire
     SUFF_NUM_MEAS = 5
+    # Number of range measurements kept for firing decisions
+    RANGE_RING_SIZE = 32
+    # Range measurements further than this [m] from the median are outliers
+    RANGE_OUTLIER_TOL = .3
+    # Fixed launch angle of the launcher [rad]
+    LAUNCH_ANGLE = .1
+    # Launch speed at the maximum firing command [m/s] (needs calibration)
+    MAX_LAUNCH_SPEED = 20.
+    # Range of firing commands sent to the ESP32
+    FIRE_COMMAND_MIN = 0
+    FIRE_COMMAND_MAX = 100
+    # Firing command used when no launch table is available
+    FIRE_COMMAND_DEFAULT = 70
+    # File holding the precomputed range-to-launch-command table
+    LAUNCH_TABLE_FILE = "launch_table.npz"
+    # Pass raw frames to the server through shared memory instead of JPEG over TCP
+    # (only when both run on the same machine)
+    LOCAL_TRANSPORT = False
+    # Server: accept such shared memory frames (only ever from clients on the same machine)
+    SHARED_MEMORY_FRAMES = True
+    # Frames the client sends before waiting for a reply (1 gives lock-step send/receive)
+    MAX_FRAMES_IN_FLIGHT = 2
+    # How long [s] the client waits for replies before assuming the frames were dropped
+    REPLY_TIMEOUT = 1.
+    # Encoding levels (scale, JPEG quality) the client steps through, best first
+    ENCODER_LEVELS = [(1., 90), (1., 75), (.75, 75), (.75, 60), (.5, 60), (.5, 45)]
+    # Round trip time [s] above which the client lowers the encoding level
+    TARGET_RTT = .25
+    # Minimum time [s] between encoding level changes
+    ENCODER_HOLD = 1.
+    # Weight of new samples in the round trip time and bandwidth averages
+    ENCODER_SMOOTHING = .2
+    # Crop frames to the region around the last reported person
+    ROI_CROP = True
+    # Margin around the person in the cropped region, relative to the person width
+    ROI_MARGIN = .5
+    # Narrower regions (in px, e.g. a box at the frame edge) are not cropped to, the full frame is sent
+    ROI_MIN_WIDTH = 8
+    # Send a full frame at least this often (in frames) to re-acquire the person
+    FULL_FRAME_PERIOD = 10
+    # Person detection backend of the server ("ultralytics", "onnx" or "openvino", see detector.py)
+    DETECTOR_BACKEND = "ultralytics"
+    # Model weights, exported models are cached next to them
+    DETECTOR_WEIGHTS = "yolov8s.pt"
+    # Model input size [px]
+    DETECTOR_IMGSZ = 640
+    # Inference threads (0: runtime default)
+    DETECTOR_THREADS = 0
+    # Use the INT8 quantized model (onnx and openvino backends)
+    DETECTOR_INT8 = False
+    # Inferences run before the server accepts connections
+    DETECTOR_WARMUP = 3
+    # Detection confidence and NMS IoU thresholds
+    DETECTOR_CONF = .25
+    DETECTOR_IOU = .7
+    # Decode JPEGs at 1/2, 1/4 or 1/8 size when that still covers the model input
+    REDUCED_DECODE = True
+    # Run the detector every this many frames per client and follow the person with
+    # optical flow in between (1: detect on every frame)
+    DETECT_PERIOD = 5
+    # Points tracked by the optical flow, and the fewest that still count as locked on
+    FLOW_MAX_POINTS = 60
+    FLOW_MIN_POINTS = 10
+    # Share of points that must survive a frame, detect again otherwise
+    FLOW_MIN_CONFIDENCE = .6
+    # Forward-backward error [px] above which a tracked point is dropped
+    FLOW_FB_ERROR = 1.
+    # Maximum number of launchers served at once
+    MAX_CLIENTS = 4
+    # How often [s] pipeline statistics are printed
+    STATS_PERIOD = 5.
+    # Log file for recording camera frames and serial traffic (None: no recording)
+    RECORD_FILE = None
+    # Log file replayed instead of using the hardware (None: use the hardware)
+    REPLAY_FILE = None
+    # Replay speed factor and whether the replay loops
+    REPLAY_SPEED = 1.
+    REPLAY_LOOP = False
+    # Collect latency histograms (negligible overhead when off)
+    TIMING = False
+    # Directory for the timing CSV files
+    TIMING_DIR = "."
+    # How often [s] the latency histograms are written
+    TIMING_PERIOD = 10.
 
     """ GLOBAL VARIABLES """
-    # Current range reading
-    RANGE = 0.
     # Flag for telling the daemons to exit
     SHOULD_EXIT = threading.Event()
-    # Current yaw error in pixels
-    YAW_ERR = 0
     # Integer value for not performing control / bogus distance measurements
     INVALID_VALUE = 69420 # Also used by the server!
-    # Current control input for the yaw
-    YAW_CONTROL = MOTOR_NEUTRAL
-    # The current encoder count (can encounter some weird values, ususally int)
-    ENCODER_COUNT = 0
+    # Values shared between the client threads, with timestamps (see state.FIELDS)
+    STATE = SharedState(yaw_err=0, yaw_err_capture_ns=0, person_bounds=(INVALID_VALUE, INVALID_VALUE),
+                        vision_latency=0., encoder_count=0, fire_request=None, yaw_int=0,
+                        yaw_control=MOTOR_NEUTRAL)
     # Tracking how long we have been receiving invalid yaw errors (give some time to initialize)
     YAW_RESET_TIMER = time.perf_counter() + YAW_TIMEOUT
     # For flagging that a reset has been done (no need to do multiple resets)
     YAW_IS_RESET = False
-    # Bounding box x-values for the person
-    PERSON_BOUNDS = [INVALID_VALUE, INVALID_VALUE]
-    # List for storing range measurements
-    RANGE_VALS = []
-    # Flag set by range thread to order ESP32 thread to start firing sequence
-    FIRE_REQUEST = False
-    # Current PWM firing command
-    FIRE_COMMAND = MOTOR_NEUTRAL
-    # Cooldown time between firings [s]
+    # Ring buffer of range measurements (range_sensor.RangeRing), created by the range thread
+    RANGE_VALS = None
+    # Cooldown time between firings [s], counted from the end of the last firing (or start up)
     FIRE_COOLDOWN = 10
-    # Timer for enforcing firing cooldown time
-    FIRE_TIMER = time.perf_counter()
-    # Integral of YAW error
-    YAW_INT = 0
+    # Capture time [ns] of the previous yaw error sample
+    PREV_YAW_ERR_NS = 0
+    # Derivative of the yaw error per YAW_GAIN_DT
+    YAW_DERIV = 0.
+    # Target prediction (target_filter.TargetFilter), created by the yaw control thread
+    TARGET_FILTER = None
+    # Range-to-launch-command table, loaded at client startup
+    LAUNCH_TABLE = None
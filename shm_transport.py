@@ -0,0 +1,92 @@
+import os
+from multiprocessing import shared_memory, resource_tracker
+import numpy as np
+
+import protocol
+
+
+class FrameRing():
+    """
+    Ring of fixed size slots for raw frames in shared memory. The client
+    creates it and writes frame seq into slot seq % slots, the server
+    attaches to it by name and reads the frames in place.
+    """
+    def __init__(self, shm: shared_memory.SharedMemory, slots: int, slot_size: int):
+        self.shm = shm
+        self.slots = slots
+        self.slot_size = slot_size
+
+    @classmethod
+    def create(cls, slots: int, slot_size: int):
+        return cls(shared_memory.SharedMemory(create=True, size=slots * slot_size), slots, slot_size)
+
+    @classmethod
+    def attach(cls, name: str, slots: int, slot_size: int):
+        # Only the creator may remove the memory, don't let this process's
+        # resource tracker unlink it at exit
+        try:
+            shm = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            # Before Python 3.13 attaching always registers the memory, under its POSIX name
+            shm = shared_memory.SharedMemory(name=name)
+            if os.name == "posix":
+                resource_tracker.unregister("/" + shm.name, "shared_memory")
+        if slots * slot_size > shm.size:
+            shm.close()
+            raise ValueError(f"Shared memory {name} is smaller than {slots} slots of {slot_size} bytes")
+        return cls(shm, slots, slot_size)
+
+    @property
+    def name(self) -> str:
+        return self.shm.name
+
+    def view(self, slot: int, shape) -> np.ndarray:
+        """The frame in a slot, without copying"""
+        if not 0 <= slot < self.slots or int(np.prod(shape)) > self.slot_size:
+            raise ValueError(f"Frame of shape {tuple(shape)} does not fit slot {slot}")
+        return np.ndarray(shape, dtype=np.uint8, buffer=self.shm.buf, offset=slot * self.slot_size)
+
+    def write(self, slot: int, frame: np.ndarray):
+        self.view(slot, frame.shape)[...] = frame
+
+    def close(self):
+        try:
+            self.shm.close()
+        except BufferError:
+            # Frames still viewed somewhere, the mapping goes away with them
+            pass
+
+    def unlink(self):
+        self.close()
+        self.shm.unlink()
+
+
+class SharedMemorySender():
+    """
+    Client side of the local transport: frames go through a FrameRing instead
+    of being JPEG encoded, the connection only carries their slot and shape
+    """
+    def __init__(self, slots: int):
+        self.slots = slots
+        self.ring = None
+        # Connection the current ring was announced on
+        self.announced = None
+
+    def send(self, sock, seq: int, capture_ns: int, frame: np.ndarray, transform=(0, 0, 1.)):
+        frame = np.ascontiguousarray(frame)
+        if self.ring is None or frame.nbytes > self.ring.slot_size:
+            if self.ring is not None:
+                self.ring.unlink()
+            self.ring = FrameRing.create(self.slots, frame.nbytes)
+            self.announced = None
+        if self.announced is not sock:
+            protocol.send_shm_open(sock, self.ring.name, self.ring.slots, self.ring.slot_size)
+            self.announced = sock
+        slot = seq % self.slots
+        self.ring.write(slot, frame)
+        protocol.send_raw_frame(sock, seq, capture_ns, slot, frame.shape, transform)
+
+    def close(self):
+        if self.ring is not None:
+            self.ring.unlink()
+            self.ring = None
@@ -1,7 +1,114 @@
+import copy
+from collections import OrderedDict
 import numpy as np
 import matplotlib.pyplot as plt
 
 
+# Dormand-Prince 5(4) coefficients, stage rows of the Butcher tableau
+_DOPRI_A = (
+    (),
+    (1 / 5,),
+    (3 / 40, 9 / 40),
+    (44 / 45, -56 / 15, 32 / 9),
+    (19372 / 6561, -25360 / 2187, 64448 / 6561, -212 / 729),
+    (9017 / 3168, -355 / 33, 46732 / 5247, 49 / 176, -5103 / 18656),
+)
+# 5th order weights
+_DOPRI_B = (35 / 384, 0., 500 / 1113, 125 / 192, -2187 / 6784, 11 / 84)
+# Difference between the 5th and 4th order weights (error estimate)
+_DOPRI_E = (71 / 57600, 0., -71 / 16695, 71 / 1920, -17253 / 339200, 22 / 525, -1 / 40)
+
+
+# Inverse solver: speeds scanned to bracket a distance, angles scanned when the angle is free
+_SCAN_SPEEDS = 24
+_SCAN_ANGLES = 25
+_MAX_ITERATIONS = 50
+# Speed resolution (m/s) the root finding stops at
+_SPEED_TOL = 1e-6
+# Resolution the solver inputs are quantized to before solving and memoizing:
+# distance (m), angle (rad), launch height (m)
+_QUANTUM = (.005, 1e-4, .001)
+
+
+class _SolutionCache():
+    """Least recently used cache of inverse solutions"""
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        solution = self.entries.get(key)
+        if solution is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.entries.move_to_end(key)
+        return solution
+
+    def put(self, key, solution):
+        self.entries[key] = solution
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = self.misses = 0
+
+
+# Shared by all simulators, keyed on their parameters. Kept off the instances
+# so vars(sim) stays the simulator parameters only (see _solve_key)
+SOLUTIONS = _SolutionCache(1 << 16)
+
+
+def _illinois(f, a, b, fa, fb, tol):
+    """Root of f between a and b (fa < 0 <= fb) with the Illinois variant of regula falsi"""
+    for _ in range(_MAX_ITERATIONS):
+        c = b - fb * (b - a) / (fb - fa)
+        fc = f(c)
+        if abs(fc) < tol or abs(c - b) < _SPEED_TOL:
+            return c
+        if fc * fb < 0:
+            a, fa = b, fb
+        else:
+            fa /= 2
+        b, fb = c, fc
+    return c
+
+
+def _parabola_vertex(x, y):
+    """Abscissa of the vertex of the parabola through three points, None if it opens downwards"""
+    denom = (x[0] - x[1]) * (x[0] - x[2]) * (x[1] - x[2])
+    a = (x[2] * (y[1] - y[0]) + x[1] * (y[0] - y[2]) + x[0] * (y[2] - y[1])) / denom
+    b = (x[2]**2 * (y[0] - y[1]) + x[1]**2 * (y[2] - y[0]) + x[0]**2 * (y[1] - y[2])) / denom
+    if not a > 0:
+        return None
+    return -b / (2 * a)
+
+
+def _hermite(theta, h, p0, v0, p1, v1):
+    """Cubic Hermite interpolation over a step of size h at fraction theta"""
+    t2 = theta * theta
+    t3 = t2 * theta
+    return (2 * t3 - 3 * t2 + 1) * p0 + (t3 - 2 * t2 + theta) * h * v0 \
+        + (3 * t2 - 2 * t3) * p1 + (t3 - t2) * h * v1
+
+
+def _ground_crossing(h, y0, vy0, y1, vy1):
+    """Fraction of a step where the Hermite interpolant of the height hits zero"""
+    # Start from the linear estimate and refine with Newton steps
+    theta = y0 / (y0 - y1)
+    for _ in range(4):
+        t2 = theta * theta
+        dy = (6 * t2 - 6 * theta) * y0 + (3 * t2 - 4 * theta + 1) * h * vy0 \
+            + (6 * theta - 6 * t2) * y1 + (3 * t2 - 2 * theta) * h * vy1
+        if dy == 0.:
+            break
+        theta = min(1., max(0., theta - _hermite(theta, h, y0, vy0, y1, vy1) / dy))
+    return theta
+
 
 class FrisbeeSimulator():
     def __init__(self):
@@ -23,13 +130,49 @@ class FrisbeeSimulator():
         # The drag coefficient dependent on alpha.
         self.cda = 2.72
         self.alpha0 = -4. * np.pi / 180
-        # Time step size
+        # Time step size (Euler)
         self.dt = .001
+        # Integrator used by simulate(): "euler", "rk4" or "adaptive"
+        self.method = "euler"
+        # Time step size (RK4) and initial step size (adaptive)
+        self.rk_dt = .02
+        # Error tolerance per step (adaptive)
+        self.tol = 1e-6
         # Initial position (static)
         self.x0 = 0.
         self.y0 = 1.
+        # Inverse solver: launch speeds (m/s) and angles (rad) searched, distance tolerance (m).
+        # The Euler landing distance moves in steps of about speed * dt, a finer
+        # tolerance ends on the speed resolution instead
+        self.solve_speed_range = (.5, 40.)
+        self.solve_angle_range = (-.1, .6)
+        self.solve_tol = .005
+
+    def simulate(self, initial_speed, initial_angle, full_path=True, method=None):
+        """
+        Simulate a single throw. With full_path the trajectory is returned as
+        lists of x and y values, otherwise only the landing distance, computed
+        without storing the path.
+        """
+        method = self.method if method is None else method
+        if not full_path:
+            return self.landing(initial_speed, initial_angle, method)[0]
+        x_vals, y_vals = [], []
+        if method == "euler":
+            self._euler(initial_speed, initial_angle, x_vals, y_vals)
+        else:
+            self._runge_kutta(initial_speed, initial_angle, method, x_vals, y_vals)
+        return x_vals, y_vals
+
+    def landing(self, initial_speed, initial_angle, method=None):
+        """Landing distance and flight time of a single throw, without storing the path"""
+        method = self.method if method is None else method
+        if method == "euler":
+            return self._euler(initial_speed, initial_angle)
+        return self._runge_kutta(initial_speed, initial_angle, method)
 
-    def simulate(self, initial_speed, initial_angle, full_path=True):
+    def _euler(self, initial_speed, initial_angle, x_vals=None, y_vals=None):
+        """Fixed step explicit Euler, stops at the first step below ground"""
         x = self.x0
         y = self.y0
         # Compute initial velocities
@@ -38,7 +181,7 @@ class FrisbeeSimulator():
         # Compute lift and drag
         Cl = self.cl0 + self.cla * initial_angle
         Cd = self.cd0 + self.cda * (initial_angle - self.alpha0) ** 2
-        x_vals, y_vals = [], []
+        steps = 0
         while y >= 0.:
             # Compute acceleration
             ax = -(self.rho * (vx ** 2) * self.area * Cd) / (2 * self.mass) * self.dt
@@ -48,16 +191,285 @@ class FrisbeeSimulator():
             vy += ay
             x += vx * self.dt
             y += vy * self.dt
-            x_vals.append(x)
-            y_vals.append(y)
-        
-        if full_path:
-            return x_vals, y_vals
+            steps += 1
+            if x_vals is not None:
+                x_vals.append(x)
+                y_vals.append(y)
+        return x, steps * self.dt
+
+    def _runge_kutta(self, initial_speed, initial_angle, method, x_vals=None, y_vals=None):
+        """
+        Fixed step RK4 ("rk4") or adaptive Dormand-Prince 5(4) ("adaptive").
+        The step crossing the ground is interpolated with a cubic Hermite
+        polynomial, so the landing point is exact up to the integrator accuracy.
+        """
+        if method not in ("rk4", "adaptive"):
+            raise ValueError(f"Unknown integrator {method}")
+        # Initial state [x, y, vx, vy]
+        state = (self.x0, self.y0,
+                 initial_speed * np.cos(initial_angle), initial_speed * np.sin(initial_angle))
+        # Drag and lift factors, constant over the flight
+        kd = self.rho * self.area * (self.cd0 + self.cda * (initial_angle - self.alpha0) ** 2) / (2 * self.mass)
+        kl = self.rho * self.area * (self.cl0 + self.cla * initial_angle) / (2 * self.mass)
+        adaptive = method == "adaptive"
+        h = self.rk_dt
+        t = 0.
+        if x_vals is not None:
+            x_vals.append(state[0])
+            y_vals.append(state[1])
+        while True:
+            if adaptive:
+                new_state, err = self._dopri_step(state, h, kd, kl)
+                # Scale the step size towards the tolerance, reject steps that miss it
+                scale = min(5., max(.2, .9 * (err + 1e-16) ** -.2))
+                if err > 1.:
+                    h *= scale
+                    continue
+            else:
+                new_state = self._rk4_step(state, h, kd, kl)
+            if new_state[1] < 0.:
+                theta = _ground_crossing(h, state[1], state[3], new_state[1], new_state[3])
+                x = _hermite(theta, h, state[0], state[2], new_state[0], new_state[2])
+                if x_vals is not None:
+                    x_vals.append(x)
+                    y_vals.append(0.)
+                return x, t + theta * h
+            state = new_state
+            t += h
+            if x_vals is not None:
+                x_vals.append(state[0])
+                y_vals.append(state[1])
+            if adaptive:
+                h *= scale
+
+    def _derivative(self, state, kd, kl):
+        vx_sq = state[2] * state[2]
+        return (state[2], state[3], -kd * vx_sq, self.g + kl * vx_sq)
+
+    def _rk4_step(self, s, h, kd, kl):
+        k1 = self._derivative(s, kd, kl)
+        k2 = self._derivative([s[i] + .5 * h * k1[i] for i in range(4)], kd, kl)
+        k3 = self._derivative([s[i] + .5 * h * k2[i] for i in range(4)], kd, kl)
+        k4 = self._derivative([s[i] + h * k3[i] for i in range(4)], kd, kl)
+        return tuple(s[i] + h / 6. * (k1[i] + 2. * k2[i] + 2. * k3[i] + k4[i]) for i in range(4))
+
+    def _dopri_step(self, s, h, kd, kl):
+        """One Dormand-Prince step, returns the 5th order state and the error relative to tol"""
+        k = []
+        for a in _DOPRI_A:
+            stage = [s[i] + h * sum(a[j] * k[j][i] for j in range(len(a))) for i in range(4)]
+            k.append(self._derivative(stage, kd, kl))
+        new_state = tuple(s[i] + h * sum(_DOPRI_B[j] * k[j][i] for j in range(6)) for i in range(4))
+        k.append(self._derivative(new_state, kd, kl))
+        err = max(abs(h * sum(_DOPRI_E[j] * k[j][i] for j in range(7))) / (self.tol * (1. + abs(new_state[i])))
+                  for i in range(4))
+        return new_state, err
+
+    def simulate_batch(self, speeds, angles, return_time=False, cl0=None, cd0=None, rho=None):
+        """
+        Simulate a whole grid of throws at once, stepping all of them together
+        as NumPy arrays. Speeds and angles are broadcast against each other, so
+        passing speed_vals[:, None] and angle_vals[None, :] gives a full sweep.
+        cl0, cd0 and rho optionally vary the parameters per throw and are
+        broadcast the same way. Returns the landing distances (and flight
+        times) in the broadcast shape.
+        """
+        params = [self.cl0 if cl0 is None else cl0, self.cd0 if cd0 is None else cd0,
+                  self.rho if rho is None else rho]
+        speeds, angles, cl0, cd0, rho = np.broadcast_arrays(
+            *(np.asarray(a, dtype=float) for a in [speeds, angles] + params))
+        shape = speeds.shape
+        speeds, angles, cl0, cd0, rho = (a.ravel() for a in (speeds, angles, cl0, cd0, rho))
+        # Output arrays, filled in as throws land
+        dists = np.empty(speeds.size)
+        times = np.empty(speeds.size)
+        # Indices of the throws that are still in the air
+        idx = np.arange(speeds.size)
+        x = np.full(speeds.size, self.x0)
+        y = np.full(speeds.size, self.y0)
+        # Compute initial velocities
+        vx = speeds * np.cos(angles)
+        vy = speeds * np.sin(angles)
+        # Lift and drag are constant per throw, fold them into the step factors
+        Cl = cl0 + self.cla * angles
+        Cd = cd0 + self.cda * (angles - self.alpha0) ** 2
+        drag = rho * self.area * Cd / (2 * self.mass) * self.dt
+        lift = rho * self.area * Cl / (2 * self.mass) * self.dt
+        g_dt = self.g * self.dt
+        steps = 0
+        while idx.size:
+            # Same explicit Euler step as simulate()
+            vx_sq = vx ** 2
+            vx -= drag * vx_sq
+            vy += g_dt + lift * vx_sq
+            x += vx * self.dt
+            y += vy * self.dt
+            steps += 1
+            landed = y < 0.
+            if landed.any():
+                # Record the landed throws and drop them from the active set
+                dists[idx[landed]] = x[landed]
+                times[idx[landed]] = steps * self.dt
+                flying = ~landed
+                idx, x, y, vx, vy, drag, lift = (a[flying] for a in (idx, x, y, vx, vy, drag, lift))
+
+        if return_time:
+            return dists.reshape(shape), times.reshape(shape)
         else:
-            return x
-            
+            return dists.reshape(shape)
+
+    def solve(self, distance, angle=None, height=None):
+        """
+        Launch (speed, angle) that lands a throw at distance [m], from launch
+        height [m] (default y0). With a fixed angle [rad] only the speed is
+        solved for, otherwise the angle needing the lowest speed is used.
+        Unreachable distances give nan. Inputs are quantized and the
+        solutions memoized, so repeated queries are near-free.
+        """
+        key, distance, angle, height = self._solve_key(distance, angle, height)
+        solution = SOLUTIONS.get(key)
+        if solution is None:
+            sim = self._at_height(height)
+            if angle is None:
+                solution = sim._solve_free_angle(distance)
+            else:
+                solution = (sim._solve_speed(distance, angle), angle)
+            SOLUTIONS.put(key, solution)
+        return solution
+
+    def solve_batch(self, distances, angle=None, height=None):
+        """
+        solve() for many distances at once, stepping all the throws that are
+        not memoized yet together with simulate_batch(). Returns the speeds
+        and angles in the shape of distances.
+        """
+        distances = np.asarray(distances, dtype=float)
+        speeds = np.empty(distances.size)
+        angles = np.empty(distances.size)
+        # Quantized distances still to solve, and where their solutions go
+        todo = OrderedDict()
+        for i, distance in enumerate(distances.ravel()):
+            key, distance, fixed_angle, height = self._solve_key(distance, angle, height)
+            solution = SOLUTIONS.get(key)
+            if solution is None:
+                todo.setdefault(key, (distance, []))[1].append(i)
+            else:
+                speeds[i], angles[i] = solution
+        if todo:
+            sim = self._at_height(height)
+            targets = np.array([distance for distance, _ in todo.values()])
+            if fixed_angle is None:
+                solved_speeds, solved_angles = sim._solve_batch_free_angle(targets)
+            else:
+                solved_angles = np.full(targets.size, fixed_angle)
+                solved_speeds = sim._solve_batch_speed(targets, solved_angles)
+            for key, (_, indices), speed, solved_angle in zip(todo, todo.values(), solved_speeds, solved_angles):
+                SOLUTIONS.put(key, (float(speed), float(solved_angle)))
+                speeds[indices] = speed
+                angles[indices] = solved_angle
+        return speeds.reshape(distances.shape), angles.reshape(distances.shape)
+
+    def _solve_key(self, distance, angle, height):
+        """Memoization key and the quantized distance, angle and height it stands for"""
+        quanta = [round(v / q) if v is not None else None
+                  for v, q in zip((distance, angle, self.y0 if height is None else height), _QUANTUM)]
+        key = (tuple(sorted(vars(self).items())), *quanta)
+        distance, angle, height = (n * q if n is not None else None for n, q in zip(quanta, _QUANTUM))
+        return key, distance, angle, height
+
+    def _at_height(self, height):
+        """This simulator launching from another height"""
+        if height == self.y0:
+            return self
+        sim = copy.copy(self)
+        sim.y0 = height
+        return sim
+
+    def _solve_speed(self, distance, angle):
+        """Speed landing a throw at the given angle at distance, nan if out of the speed range"""
+        def miss(speed):
+            return self.landing(speed, angle, "euler")[0] - distance
 
+        # Bracket the lowest speed that reaches the distance, distance grows with speed
+        speeds = np.geomspace(*self.solve_speed_range, _SCAN_SPEEDS)
+        a, fa = speeds[0], miss(speeds[0])
+        if fa >= 0:
+            return np.nan
+        for b in speeds[1:]:
+            fb = miss(b)
+            if fb >= 0:
+                return float(_illinois(miss, a, b, fa, fb, self.solve_tol))
+            a, fa = b, fb
+        return np.nan
 
+    def _solve_free_angle(self, distance):
+        """Lowest speed (and its angle) landing a throw at distance"""
+        grid = np.linspace(*self.solve_angle_range, _SCAN_ANGLES)
+        speeds = np.array([self._solve_speed(distance, angle) for angle in grid])
+        return self._best_angle(grid, speeds[None, :],
+                                lambda rows, angles: [self._solve_speed(distance, a) for a in angles])[0]
+
+    def _best_angle(self, grid, speeds, solve_at):
+        """
+        Per row of speeds over the angle grid, the lowest speed and its angle,
+        refined with the vertex of the parabola through the best grid point and
+        its neighbours. solve_at(rows, angles) solves the speeds of rows at angles.
+        """
+        solutions = []
+        refine, refine_angles = [], []
+        for row in range(len(speeds)):
+            if np.all(np.isnan(speeds[row])):
+                solutions.append((np.nan, np.nan))
+                continue
+            best = int(np.nanargmin(speeds[row]))
+            solutions.append((float(speeds[row, best]), float(grid[best])))
+            if 0 < best < len(grid) - 1 and not np.any(np.isnan(speeds[row, best - 1:best + 2])):
+                vertex = _parabola_vertex(grid[best - 1:best + 2], speeds[row, best - 1:best + 2])
+                if vertex is not None:
+                    refine.append(row)
+                    refine_angles.append(vertex)
+        if refine:
+            refined = solve_at(np.array(refine), np.array(refine_angles))
+            for row, speed, angle in zip(refine, refined, refine_angles):
+                if speed < solutions[row][0]:
+                    solutions[row] = (float(speed), float(angle))
+        return solutions
+
+    def _solve_batch_speed(self, distances, angles):
+        """_solve_speed() for arrays of distances and angles, iterating on all of them together"""
+        grid = np.geomspace(*self.solve_speed_range, _SCAN_SPEEDS)
+        unique_angles, inverse = np.unique(angles, return_inverse=True)
+        scan = self.simulate_batch(grid[:, None], unique_angles[None, :])[:, inverse] - distances
+        # First grid speed reaching each distance, the one before it brackets the root from below
+        reached = scan >= 0
+        upper = np.argmax(reached, axis=0)
+        speeds = np.full(distances.size, np.nan)
+        idx = np.nonzero(reached.any(axis=0) & (upper > 0))[0]
+        a, b = grid[upper[idx] - 1], grid[upper[idx]]
+        fa, fb = scan[upper[idx] - 1, idx], scan[upper[idx], idx]
+        # Illinois iterations on all the unsolved distances at once
+        for _ in range(_MAX_ITERATIONS):
+            if not idx.size:
+                break
+            c = b - fb * (b - a) / (fb - fa)
+            fc = self.simulate_batch(c, angles[idx]) - distances[idx]
+            done = (np.abs(fc) < self.solve_tol) | (np.abs(c - b) < _SPEED_TOL)
+            speeds[idx[done]] = c[done]
+            flip = fc * fb < 0
+            a, fa = np.where(flip, b, a), np.where(flip, fb, fa / 2)
+            b, fb = c, fc
+            idx, a, b, fa, fb = (v[~done] for v in (idx, a, b, fa, fb))
+        speeds[idx] = b
+        return speeds
+
+    def _solve_batch_free_angle(self, distances):
+        """_solve_free_angle() for an array of distances"""
+        grid = np.linspace(*self.solve_angle_range, _SCAN_ANGLES)
+        speeds = self._solve_batch_speed(np.repeat(distances, grid.size), np.tile(grid, distances.size))
+        solutions = self._best_angle(grid, speeds.reshape(distances.size, grid.size),
+                                     lambda rows, angles: self._solve_batch_speed(distances[rows], angles))
+        speeds, angles = np.array(solutions).reshape(-1, 2).T
+        return speeds, angles
 
 
 if __name__ == "__main__":
@@ -87,4 +499,12 @@ if __name__ == "__main__":
     plt.show()
     """
 
-    
\ No newline at end of file
+    # Full speed/angle sweep in one batched call
+    dists = sim.simulate_batch(speed_vals[:, None], angle_vals[None, :])
+
+    # Sweep plot
+    plt.contourf(angle_vals, speed_vals, dists, levels=30)
+    plt.xlabel("Initial angle [rad]")
+    plt.ylabel("Initial speed [m/s]")
+    plt.colorbar(label="Distance [m]")
+    plt.show()
@@ -0,0 +1,176 @@
+import os
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+import settings
+import launch_table
+from simulation.main import FrisbeeSimulator
+
+
+class Distribution():
+    """Zero mean perturbation: "normal" with standard deviation spread, or "uniform" within +-spread"""
+    def __init__(self, kind: str = "normal", spread: float = 0.):
+        if kind not in ("normal", "uniform"):
+            raise ValueError(f"Unknown distribution {kind}")
+        self.kind = kind
+        self.spread = spread
+
+    def sample(self, rng, size):
+        if self.spread == 0.:
+            return np.zeros(size)
+        if self.kind == "normal":
+            return rng.normal(0., self.spread, size)
+        return rng.uniform(-self.spread, self.spread, size)
+
+
+class Dispersion():
+    """Throw to throw variation of the launch, the flight and the range measurement"""
+    def __init__(self, kind: str = "normal"):
+        """ PARAMETERS """
+        # Launch speed, relative to the commanded speed
+        self.speed = Distribution(kind, .03)
+        # Launch angle (rad)
+        self.angle = Distribution(kind, 2. * np.pi / 180)
+        # Lift and drag coefficients at alpha = 0
+        self.cl0 = Distribution(kind, .02)
+        self.cd0 = Distribution(kind, .01)
+        # Air density (kg/m^3)
+        self.rho = Distribution(kind, .03)
+        # Range sensor noise (m)
+        self.range = Distribution(kind, .05)
+        # Share of range measurements that are outliers, anywhere up to twice the distance
+        self.range_outliers = .02
+
+
+def robust_mean(samples, tolerance: float):
+    """Row-wise range_sensor.RangeRing.robust_mean: mean of the samples within tolerance of the median"""
+    median = np.median(samples, axis=1, keepdims=True)
+    inliers = np.abs(samples - median) <= tolerance
+    return np.sum(samples * inliers, axis=1) / np.sum(inliers, axis=1)
+
+
+def throw_errors(distance: float, num_meas: int, throws: int, seed, dispersion: Dispersion,
+                 table: launch_table.LaunchTable, sim: FrisbeeSimulator):
+    """
+    Landing errors [m] of throws at a target at distance [m], going through the
+    same steps as the launcher: averaging num_meas range measurements, looking
+    up the launch command and launching with dispersed parameters
+    """
+    rng = np.random.default_rng(seed)
+    samples = distance + dispersion.range.sample(rng, (throws, num_meas))
+    outliers = rng.random((throws, num_meas)) < dispersion.range_outliers
+    samples[outliers] = rng.uniform(0., 2. * distance, np.count_nonzero(outliers))
+    measured = robust_mean(samples, settings.RANGE_OUTLIER_TOL)
+    speeds = launch_table.command_to_speed(table.lookup_array(measured))
+    speeds = speeds * (1. + dispersion.speed.sample(rng, throws))
+    angles = settings.LAUNCH_ANGLE + dispersion.angle.sample(rng, throws)
+    landing = sim.simulate_batch(speeds, angles,
+                                 cl0=sim.cl0 + dispersion.cl0.sample(rng, throws),
+                                 cd0=sim.cd0 + dispersion.cd0.sample(rng, throws),
+                                 rho=sim.rho + dispersion.rho.sample(rng, throws))
+    return landing - distance
+
+
+def _init_worker():
+    settings.init()
+
+
+def _throw_errors(args):
+    return throw_errors(*args)
+
+
+def run(distances, num_meas_values, throws: int, dispersion: Dispersion, table: launch_table.LaunchTable,
+        sim: FrisbeeSimulator = None, seed: int = 0, workers: int = None, chunk: int = 20000):
+    """
+    Landing errors for every (distance, number of measurements) pair, with the
+    throws split into chunks over a process pool. Every chunk has its own seed
+    spawned from seed, so the results don't depend on the number of workers.
+    """
+    sim = sim or FrisbeeSimulator()
+    tasks, keys = [], []
+    num_chunks = -(-throws // chunk)
+    configs = [(distance, num_meas) for distance in distances for num_meas in num_meas_values]
+    seeds = np.random.SeedSequence(seed).spawn(len(configs) * num_chunks)
+    for i, (distance, num_meas) in enumerate(configs):
+        for j in range(num_chunks):
+            size = min(chunk, throws - j * chunk)
+            tasks.append((distance, num_meas, size, seeds[i * num_chunks + j], dispersion, table, sim))
+            keys.append((distance, num_meas))
+    errors = {config: [] for config in configs}
+    with ProcessPoolExecutor(workers, initializer=_init_worker) as pool:
+        for key, result in zip(keys, pool.map(_throw_errors, tasks)):
+            errors[key].append(result)
+    return {config: np.concatenate(chunks) for config, chunks in errors.items()}
+
+
+def summarize(errors, radius: float) -> dict:
+    """Spread of the landing errors [m] and hit probability within radius [m] with its 95% interval"""
+    n = len(errors)
+    abs_errors = np.abs(errors)
+    p = np.count_nonzero(abs_errors <= radius) / n
+    # Wilson score interval
+    z = 1.96
+    center = (p + z**2 / (2 * n)) / (1 + z**2 / n)
+    half = z * np.sqrt(p * (1 - p) / n + z**2 / (4 * n**2)) / (1 + z**2 / n)
+    return {
+        "bias_m": float(np.mean(errors)),
+        "std_m": float(np.std(errors)),
+        "p5_m": float(np.percentile(errors, 5)),
+        "p95_m": float(np.percentile(errors, 95)),
+        "hit_%": 100. * p,
+        "hit_lo_%": 100. * (center - half),
+        "hit_hi_%": 100. * (center + half),
+        # Target radius needed for 90 / 95 % hits
+        "r90_m": float(np.percentile(abs_errors, 90)),
+        "r95_m": float(np.percentile(abs_errors, 95)),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Monte Carlo dispersion analysis of the launcher")
+    parser.add_argument("--distances", type=float, nargs="+", default=[4., 6., 8., 10., 12.],
+                        help="target distances [m]")
+    parser.add_argument("--num-meas", type=int, nargs="+", default=None,
+                        help="range measurements averaged per throw (default: 1, 3 and SUFF_NUM_MEAS)")
+    parser.add_argument("--throws", type=int, default=100000, help="throws per distance and number of measurements")
+    parser.add_argument("--radius", type=float, default=1., help="target radius [m] counted as a hit")
+    parser.add_argument("--distribution", choices=("normal", "uniform"), default="normal")
+    parser.add_argument("--speed", type=float, help="relative launch speed spread")
+    parser.add_argument("--angle", type=float, help="launch angle spread [deg]")
+    parser.add_argument("--cl0", type=float, help="cl0 spread")
+    parser.add_argument("--cd0", type=float, help="cd0 spread")
+    parser.add_argument("--rho", type=float, help="air density spread [kg/m^3]")
+    parser.add_argument("--range", type=float, help="range sensor noise spread [m]")
+    parser.add_argument("--range-outliers", type=float, help="share of outlier range measurements")
+    parser.add_argument("--table", help="launch table file to reuse if it matches the simulator "
+                                        "(default: LAUNCH_TABLE_FILE), never written")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, help="worker processes (default: all cores)")
+    args = parser.parse_args()
+
+    # Settings are needed for the launch angle, command limits and outlier tolerance
+    settings.init()
+    sim = FrisbeeSimulator()
+    # Built in memory when there is no matching table file, nothing is written
+    table = launch_table.cached_table(args.table or settings.LAUNCH_TABLE_FILE, sim) \
+        or launch_table.build_table(sim)
+    dispersion = Dispersion(args.distribution)
+    for name in ("speed", "cl0", "cd0", "rho", "range"):
+        if getattr(args, name) is not None:
+            getattr(dispersion, name).spread = getattr(args, name)
+    if args.angle is not None:
+        dispersion.angle.spread = args.angle * np.pi / 180
+    if args.range_outliers is not None:
+        dispersion.range_outliers = args.range_outliers
+    num_meas_values = args.num_meas or sorted({1, 3, settings.SUFF_NUM_MEAS})
+
+    results = run(args.distances, num_meas_values, args.throws, dispersion, table, sim, args.seed,
+                  args.workers or os.cpu_count())
+    print(f"{args.throws} throws per row, hits within {args.radius} m")
+    rows = [dict(distance_m=distance, num_meas=num_meas, **summarize(errors, args.radius))
+            for (distance, num_meas), errors in results.items()]
+    columns = list(rows[0])
+    print("  ".join(f"{c:>10}" for c in columns))
+    for row in rows:
+        print("  ".join(f"{row[c]:>10.3f}" if isinstance(row[c], float) else f"{row[c]:>10}" for c in columns))
@@ -0,0 +1,95 @@
+import time
+import threading
+
+# Fields shared between the client threads
+FIELDS = (
+    # Current yaw error in pixels
+    "yaw_err",
+    # Capture time [ns] of the frame the yaw error was computed from
+    "yaw_err_capture_ns",
+    # Bounding box x-values for the person
+    "person_bounds",
+    # Latest measured time from frame capture to receiving its reply [s]
+    "vision_latency",
+    # The current encoder count
+    "encoder_count",
+    # Firing command the range thread orders the ESP32 threads to fire with, None
+    # when there is no request. Cleared when the firing is finished, so its write
+    # time also starts the firing cooldown.
+    "fire_request",
+    # Integral of the yaw error
+    "yaw_int",
+    # Current control input for the yaw
+    "yaw_control",
+)
+_INDEX = {name: i for i, name in enumerate(FIELDS)}
+
+
+class Snapshot(tuple):
+    """Field values read together, with the ages [s] they had at that moment"""
+    def __new__(cls, names, values, ages):
+        snapshot = super().__new__(cls, values)
+        snapshot.ages = dict(zip(names, ages))
+        return snapshot
+
+    def age(self, name: str) -> float:
+        return self.ages[name]
+
+    def fresh(self, name: str, max_age: float) -> bool:
+        return self.ages[name] <= max_age
+
+
+class SharedState():
+    """
+    Values shared between threads, each with the monotonic time it was last
+    written. Writers are serialized by a lock; readers never lock, they use a
+    sequence counter (seqlock) to get consistent snapshots of several fields.
+    Single fields can be read directly as attributes.
+    """
+    __slots__ = FIELDS + ("_seq", "_stamps", "_lock")
+
+    def __init__(self, **values):
+        self._seq = 0
+        self._lock = threading.Lock()
+        now = time.perf_counter()
+        self._stamps = [now] * len(FIELDS)
+        for name in FIELDS:
+            object.__setattr__(self, name, values.get(name))
+
+    def __setattr__(self, name, value):
+        if name in _INDEX:
+            self.update(**{name: value})
+        else:
+            object.__setattr__(self, name, value)
+
+    def update(self, **values):
+        """Write one or more fields as one atomic change"""
+        now = time.perf_counter()
+        with self._lock:
+            # Odd sequence numbers mark a write in progress
+            object.__setattr__(self, "_seq", self._seq + 1)
+            for name, value in values.items():
+                object.__setattr__(self, name, value)
+                self._stamps[_INDEX[name]] = now
+            object.__setattr__(self, "_seq", self._seq + 1)
+
+    def snapshot(self, *names) -> Snapshot:
+        """
+        Consistent values of the given fields with their ages, retried if a
+        write got in between. Unpacks like a tuple of the values.
+        """
+        while True:
+            seq = self._seq
+            if seq & 1:
+                # Let the writer finish
+                time.sleep(0)
+                continue
+            values = tuple(getattr(self, name) for name in names)
+            stamps = [self._stamps[_INDEX[name]] for name in names]
+            if self._seq == seq:
+                now = time.perf_counter()
+                return Snapshot(names, values, [now - stamp for stamp in stamps])
+
+    def age(self, name: str) -> float:
+        """Time [s] since the field was last written"""
+        return time.perf_counter() - self._stamps[_INDEX[name]]
@@ -0,0 +1,90 @@
+from collections import deque
+import numpy as np
+
+
+class TargetFilter():
+    """
+    Constant velocity Kalman filter on the target bearing in encoder counts,
+    i.e. fixed to the ground rather than to the turning camera. Vision samples
+    are fused with the encoder count at their capture time, and the yaw error
+    is predicted from the filter to the current time and encoder count, so it
+    stays current between (and despite the latency of) vision updates.
+    """
+    def __init__(self, px_per_count: float, accel_noise: float, meas_noise: float, vel_var: float,
+                 max_horizon: float, history: int = 256):
+        # Image pixels per encoder count (signed, see settings.YAW_PX_PER_COUNT)
+        self.px_per_count = px_per_count
+        # Spectral density of the target acceleration [counts^2/s^3]
+        self.accel_noise = accel_noise
+        # Variance of a vision bearing measurement [counts^2]
+        self.meas_noise = meas_noise
+        # Variance of the velocity of a newly seen target [(counts/s)^2]
+        self.vel_var = vel_var
+        # Longest prediction [s] from the last vision sample
+        self.max_horizon = max_horizon
+        # Recent (time [s], encoder count) samples
+        self.encoder = deque(maxlen=history)
+        self.reset()
+
+    def reset(self):
+        """Forget the target, e.g. when it is lost"""
+        # Bearing [counts] and angular velocity [counts/s] at time self.t [s]
+        self.x = None
+        self.P = None
+        self.t = None
+        self.capture_ns = None
+
+    def add_encoder(self, t: float, count: float):
+        """Record the encoder count read at time t [s], a sample already recorded is skipped"""
+        if not self.encoder or t > self.encoder[-1][0]:
+            self.encoder.append((t, count))
+
+    def encoder_at(self, t: float) -> float:
+        """Encoder count at time t [s], interpolated from the history"""
+        times, counts = zip(*self.encoder)
+        return float(np.interp(t, times, counts))
+
+    def update(self, t: float, yaw_err: float):
+        """Fuse a yaw error [px] measured in a frame captured at time t [s]"""
+        if not self.encoder:
+            return
+        z = self.encoder_at(t) + yaw_err / self.px_per_count
+        if self.x is None:
+            self.x = np.array([z, 0.])
+            self.P = np.diag([self.meas_noise, self.vel_var])
+            self.t = t
+            return
+        dt = t - self.t
+        if dt < 0:
+            # Older than what the filter already has
+            return
+        F = np.array([[1., dt], [0., 1.]])
+        Q = self.accel_noise * np.array([[dt**3 / 3, dt**2 / 2], [dt**2 / 2, dt]])
+        self.x = F @ self.x
+        self.P = F @ self.P @ F.T + Q
+        # Scalar measurement of the bearing
+        S = self.P[0, 0] + self.meas_noise
+        K = self.P[:, 0] / S
+        self.x = self.x + K * (z - self.x[0])
+        self.P = self.P - np.outer(K, self.P[0])
+        self.t = t
+
+    def predict(self, t: float, count: float):
+        """Predicted yaw error [px] at time t [s] and encoder count, None without a target"""
+        if self.x is None:
+            return None
+        horizon = min(max(t - self.t, 0.), self.max_horizon)
+        bearing = self.x[0] + self.x[1] * horizon
+        return self.px_per_count * (bearing - count)
+
+    def track(self, t: float, count: float, count_t: float, capture_ns: int, yaw_err: float):
+        """
+        One control tick at time t [s]: record the encoder count read at time
+        count_t [s], fuse the vision sample if it is new, and return the
+        predicted yaw error [px]
+        """
+        self.add_encoder(count_t, count)
+        if capture_ns != self.capture_ns:
+            self.capture_ns = capture_ns
+            self.update(capture_ns * 1e-9, yaw_err)
+        return self.predict(t, count)
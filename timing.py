@@ -0,0 +1,88 @@
+import os
+import math
+import time
+import threading
+
+import settings
+
+# Histogram bins are log-spaced from 1 us to 100 s
+_MIN_LOG = 3.
+_BINS_PER_DECADE = 20
+_NUM_BINS = 8 * _BINS_PER_DECADE
+
+_lock = threading.Lock()
+_histograms = {}
+
+
+class Histogram():
+    """Log-spaced histogram of span durations [ns]"""
+    def __init__(self):
+        self.counts = [0] * _NUM_BINS
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, duration: int):
+        if duration > 0:
+            i = int((math.log10(duration) - _MIN_LOG) * _BINS_PER_DECADE)
+            self.counts[min(max(i, 0), _NUM_BINS - 1)] += 1
+        self.count += 1
+        self.total += duration
+        self.max = max(self.max, duration)
+
+    def percentile(self, p: float) -> float:
+        """Approximate percentile [ns], the geometric center of the bin it falls in"""
+        target = p / 100. * self.count
+        cumulative = 0
+        for i, count in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= target and count:
+                return 10 ** (_MIN_LOG + (i + .5) / _BINS_PER_DECADE)
+        return 0.
+
+
+def now() -> int:
+    return time.perf_counter_ns()
+
+
+def span(name: str, start_ns: int, end_ns: int = None):
+    """Record the duration of a span, does nothing unless settings.TIMING is set"""
+    if not settings.TIMING:
+        return
+    if end_ns is None:
+        end_ns = time.perf_counter_ns()
+    with _lock:
+        if name not in _histograms:
+            _histograms[name] = Histogram()
+        _histograms[name].add(end_ns - start_ns)
+
+
+def dump(path: str):
+    """Append count, mean, p50/p95/p99 and max [ms] of every span to a CSV file"""
+    with _lock:
+        rows = [(name, h.count, h.total / max(h.count, 1), h.percentile(50), h.percentile(95),
+                 h.percentile(99), h.max) for name, h in sorted(_histograms.items())]
+    new_file = not os.path.exists(path)
+    with open(path, "a") as f:
+        if new_file:
+            f.write("time,span,count,mean_ms,p50_ms,p95_ms,p99_ms,max_ms\n")
+        stamp = time.time()
+        for name, count, *values in rows:
+            f.write(f"{stamp:.3f},{name},{count}," + ",".join(f"{v * 1e-6:.3f}" for v in values) + "\n")
+
+
+def start(name: str) -> threading.Thread:
+    """Start a daemon thread periodically dumping the histograms to timing_<name>.csv"""
+    if not settings.TIMING:
+        return None
+    path = os.path.join(settings.TIMING_DIR, f"timing_{name}.csv")
+
+    def run():
+        while not settings.SHOULD_EXIT.wait(settings.TIMING_PERIOD):
+            dump(path)
+        dump(path)
+
+    print(f"Writing timing statistics to {path}")
+    thread = threading.Thread(target=run, name="timing", daemon=True)
+    thread.start()
+    return thread
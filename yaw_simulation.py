@@ -0,0 +1,256 @@
+import io
+import os
+import argparse
+import contextlib
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+import settings
+import state
+import motor_control
+
+
+class VirtualClock():
+    """Stand-in for the time module, so the control code runs on simulated time"""
+    def __init__(self, t: float = 1.):
+        self.t = t
+
+    def perf_counter(self) -> float:
+        return self.t
+
+    def perf_counter_ns(self) -> int:
+        return int(self.t * 1e9)
+
+    def sleep(self, seconds: float):
+        self.t += max(seconds, 0.)
+
+
+@contextlib.contextmanager
+def virtual_time(clock: VirtualClock):
+    """Run the shared state and the yaw controller on the given clock"""
+    modules = (state, motor_control)
+    real = [module.time for module in modules]
+    for module in modules:
+        module.time = clock
+    try:
+        yield clock
+    finally:
+        for module, time in zip(modules, real):
+            module.time = time
+
+
+class YawPlant():
+    """
+    The launcher yaw: the PWM command gives a motor percentage, the motor
+    speed follows it with a first order lag, and a deadband models friction
+    """
+    def __init__(self):
+        """ PARAMETERS """
+        # Encoder speed at full motor command [counts/s]
+        self.max_speed = 2000.
+        # Time constant of the motor speed [s]
+        self.tau = .08
+        # Motor percentage below which the launcher does not move
+        self.deadband = 8.
+        # Hard stops of the yaw [counts]
+        self.hard_limit = 1.2 * settings.YAW_LIMIT
+        # Vision latency from capture to reply [s], and its jitter (standard deviation)
+        self.latency = .15
+        self.latency_jitter = .03
+        # Noise of the vision yaw error [px]
+        self.pixel_noise = 2.
+
+    def percentage(self, pwm: int) -> float:
+        """Signed motor percentage of a PWM duty cycle value, inverse of the motor_control maps"""
+        if pwm <= 150:
+            return (150 - pwm) / .12
+        if pwm >= 160:
+            return -(pwm - 160) / .12
+        return 0.
+
+
+class Scenario():
+    """A target at a start bearing [counts] moving at a constant speed [counts/s]"""
+    def __init__(self, name: str, bearing: float, speed: float = 0., duration: float = 4.):
+        self.name = name
+        self.bearing = bearing
+        self.speed = speed
+        self.duration = duration
+
+    def target(self, t: float) -> float:
+        return self.bearing + self.speed * t
+
+
+SCENARIOS = [
+    Scenario("step-left", 250.),
+    Scenario("step-right", -250.),
+    Scenario("moving", 150., speed=-100.),
+]
+
+
+def reset_controller():
+    """Start the yaw controller from scratch, as on a fresh client"""
+    settings.PREV_YAW_ERR = 0
+    settings.PREV_YAW_ERR_NS = 0
+    settings.YAW_DERIV = 0.
+    settings.STATE.update(yaw_err=settings.INVALID_VALUE, yaw_err_capture_ns=0, encoder_count=0,
+                          yaw_int=0, yaw_control=settings.MOTOR_NEUTRAL)
+    settings.TARGET_FILTER = None
+    if settings.TARGET_PREDICTION:
+        settings.TARGET_FILTER = motor_control.TargetFilter(
+            settings.YAW_PX_PER_COUNT, settings.TARGET_ACCEL_NOISE, settings.TARGET_MEAS_NOISE,
+            settings.TARGET_VEL_VAR, settings.TARGET_MAX_HORIZON)
+
+
+def simulate(gains, scenario: Scenario, plant: YawPlant = None, seed: int = 0, tolerance: float = 10.):
+    """
+    Closed loop run of motor_control.yaw_control against the plant, with frames
+    captured at settings.CAM_FPS and their replies arriving after the vision
+    latency. Returns the trace of (time, true yaw error [px], encoder count)
+    and the settling time [s] (inf if never within tolerance [px] for good),
+    overshoot [% of the initial error] and number of control ticks at the yaw limit.
+    """
+    plant = plant or YawPlant()
+    rng = np.random.default_rng(seed)
+    settings.K_P_YAW, settings.K_I_YAW, settings.K_D_YAW = gains
+    clock = VirtualClock()
+    dt = 1. / settings.YAW_CONTROL_RATE
+    start = clock.t
+    count = 0.
+    speed = 0.
+    next_frame = start
+    # Replies in flight: (arrival time, capture time, yaw error)
+    replies = []
+    trace = []
+    limit_ticks = 0
+    with virtual_time(clock), contextlib.redirect_stdout(io.StringIO()):
+        reset_controller()
+        while clock.t - start < scenario.duration:
+            t = clock.t - start
+            error = settings.YAW_PX_PER_COUNT * (scenario.target(t) - count)
+            # Capture a frame, the target is only seen when it is in the image
+            if clock.t >= next_frame:
+                next_frame += 1. / settings.CAM_FPS
+                if abs(error) < settings.IMG_WIDTH / 2:
+                    measured = int(error + rng.normal(0., plant.pixel_noise))
+                else:
+                    measured = settings.INVALID_VALUE
+                latency = max(plant.latency + rng.normal(0., plant.latency_jitter), 0.)
+                replies.append((clock.t + latency, clock.t, measured))
+            # Deliver the replies that arrived, newest capture wins like in the client
+            arrived = [reply for reply in replies if reply[0] <= clock.t]
+            if arrived:
+                replies = [reply for reply in replies if reply[0] > clock.t]
+                _, capture, measured = max(arrived, key=lambda reply: reply[1])
+                settings.STATE.update(yaw_err=measured, yaw_err_capture_ns=int(capture * 1e9))
+            settings.STATE.encoder_count = int(count)
+
+            pwm = motor_control.yaw_control(dt)
+
+            # Motor response, positive commands reduce positive yaw errors
+            command = plant.percentage(pwm)
+            if abs(command) < plant.deadband:
+                command = 0.
+            target_speed = np.sign(settings.YAW_PX_PER_COUNT) * plant.max_speed * command / 100.
+            speed += (target_speed - speed) * min(dt / plant.tau, 1.)
+            count = float(np.clip(count + speed * dt, -plant.hard_limit, plant.hard_limit))
+            limit_ticks += abs(count) >= settings.YAW_LIMIT
+            trace.append((t, error, count))
+            clock.sleep(dt)
+
+    trace = np.array(trace)
+    errors = trace[:, 1]
+    outside = np.nonzero(np.abs(errors) >= tolerance)[0]
+    if not len(outside):
+        settling = 0.
+    elif outside[-1] == len(errors) - 1:
+        settling = np.inf
+    else:
+        settling = trace[outside[-1] + 1, 0]
+    initial = errors[0]
+    overshoot = max(0., -np.min(errors * np.sign(initial))) / abs(initial) * 100. if initial else 0.
+    return trace, settling, overshoot, limit_ticks
+
+
+def evaluate(gains, seed: int = 0) -> dict:
+    """Worst settling time and overshoot and total limit hits over all scenarios"""
+    results = [simulate(gains, scenario, seed=seed + i)[1:] for i, scenario in enumerate(SCENARIOS)]
+    settling, overshoot, limit_ticks = zip(*results)
+    return {
+        "K_P": gains[0], "K_I": gains[1], "K_D": gains[2],
+        "settling_s": max(settling),
+        "overshoot_%": max(overshoot),
+        "limit_ticks": sum(limit_ticks),
+    }
+
+
+def cost(result: dict) -> float:
+    """Rank candidates by settling time, penalizing overshoot and running into the limits"""
+    return result["settling_s"] + .01 * result["overshoot_%"] + .1 * result["limit_ticks"]
+
+
+def _init_worker():
+    settings.init()
+
+
+def _evaluate(args):
+    return evaluate(*args)
+
+
+def candidates(num: int, seed: int):
+    """Log-uniformly sampled gains around the ranges the hand tuned gains are in"""
+    rng = np.random.default_rng(seed)
+    k_p = 10 ** rng.uniform(-2, 0, num)
+    k_i = 10 ** rng.uniform(-6, -3, num)
+    k_d = np.concatenate([[0.], 10 ** rng.uniform(-3, 0, num - 1)])
+    return list(zip(k_p, k_i, k_d))
+
+
+def autotune(num: int = 2000, seed: int = 0, workers: int = None):
+    """Evaluate num random gain candidates over a process pool, returns the results best first"""
+    gains = candidates(num, seed)
+    # Few large chunks, a single run only takes milliseconds
+    chunksize = max(num // (4 * (workers or os.cpu_count() or 1)), 1)
+    with ProcessPoolExecutor(workers, initializer=_init_worker) as pool:
+        results = list(pool.map(_evaluate, [(g, seed) for g in gains], chunksize=chunksize))
+    return sorted(results, key=cost)
+
+
+def format_results(results) -> str:
+    columns = list(results[0])
+    lines = ["  ".join(f"{c:>12}" for c in columns)]
+    for row in results:
+        lines.append("  ".join(f"{row[c]:>12.3g}" for c in columns))
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Simulate the yaw control loop and autotune its PID gains")
+    parser.add_argument("--candidates", type=int, default=2000, help="number of gain candidates")
+    parser.add_argument("--workers", type=int, help="worker processes (default: all cores)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--top", type=int, default=10, help="number of best candidates to print")
+    parser.add_argument("--plot", action="store_true", help="plot the best candidate against the current gains")
+    args = parser.parse_args()
+
+    _init_worker()
+    current = (settings.K_P_YAW, settings.K_I_YAW, settings.K_D_YAW)
+    print("Current gains")
+    print(format_results([evaluate(current, args.seed)]))
+    results = autotune(args.candidates, args.seed, args.workers)
+    print(f"Best of {len(results)} candidates")
+    print(format_results(results[:args.top]))
+
+    if args.plot:
+        import matplotlib.pyplot as plt
+        best = (results[0]["K_P"], results[0]["K_I"], results[0]["K_D"])
+        fig, axes = plt.subplots(len(SCENARIOS), 1, sharex=True)
+        for ax, scenario in zip(axes, SCENARIOS):
+            for label, gains in (("current", current), ("best", best)):
+                trace = simulate(gains, scenario, seed=args.seed)[0]
+                ax.plot(trace[:, 0], trace[:, 1], label=label)
+            ax.set_title(scenario.name)
+            ax.set_ylabel("Yaw error [px]")
+        axes[-1].set_xlabel("Time [s]")
+        axes[0].legend()
+        plt.show()